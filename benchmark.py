@@ -0,0 +1,251 @@
+import json
+import math
+import os
+import platform
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from os.path import join
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak RSS is not reported there
+    resource = None
+
+import ciff_backends
+from ciff import CIFF
+from ciff_budget import MemoryBudget
+
+KIB = 1024
+MIB = 1024 * KIB
+GIB = 1024 * MIB
+
+# sizes of the synthetic images, from 1 KiB up to 1 GiB
+SYNTHETIC_SIZES = [KIB, 16 * KIB, 256 * KIB, 4 * MIB, 64 * MIB, GIB]
+
+# backends the calibration file may choose from; the lab2 parser is
+# left out because it does not follow the same validation rules
+CALIBRATION_CANDIDATES = ("python", "mmap", "native")
+
+# width of the synthetic images in pixels
+SYNTHETIC_WIDTH = 1024
+
+
+def size_label(size):
+    """
+    Formats a size in bytes as a short label, e.g. 256KiB
+
+    :param size: size in bytes
+    :return: str
+    """
+    for unit, name in ((GIB, "GiB"), (MIB, "MiB"), (KIB, "KiB")):
+        if size >= unit and size % unit == 0:
+            return f"{size // unit}{name}"
+    return f"{size}B"
+
+
+def write_synthetic_image(file_path, size):
+    """
+    Writes a valid CIFF image of about the given size
+
+    :param file_path: path of the file to create
+    :param size: approximate size of the file in bytes
+    """
+    caption = "synthetic benchmark image"
+    tags = ["benchmark", "synthetic"]
+    header_size = 36 + len(caption) + 1 + sum(len(tag) + 1 for tag in tags)
+    pixel_count = max(0, size - header_size) // 3
+    width = min(pixel_count, SYNTHETIC_WIDTH)
+    height = pixel_count // width if width else 0
+    row = bytes(i % 256 for i in range(width * 3))
+    with open(file_path, "wb") as ciff_file:
+        CIFF.write_ciff(ciff_file, width, height, (row for _ in range(height)), caption, tags)
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of a list of values
+
+    :param values: list of numbers
+    :param fraction: percentile in [0, 1]
+    :return: the value at the given percentile
+    """
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+def peak_rss():
+    """
+    Peak resident set size of the current process
+
+    :return: bytes, or None if it cannot be measured on this platform
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_case(backend, file_paths, repeat, max_seconds, touch):
+    """
+    Parses every file with one backend, this runs in a fresh process
+
+    :param backend: name of the backend
+    :param file_paths: list of files to parse
+    :param repeat: how many times to parse the whole list
+    :param max_seconds: stop repeating after this much time (one round always runs)
+    :param touch: read every pixel byte, so lazy backends pay for the pixels too
+    :return: dict of the measurements
+    """
+    baseline_rss = peak_rss()
+    # every backend is measured as it is, without falling back to a mapping
+    unlimited = MemoryBudget(sys.maxsize, sys.maxsize)
+    latencies = []
+    valid = 0
+    total_bytes = 0
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for file_path in file_paths:
+            parse_started = time.perf_counter()
+            parsed = ciff_backends.parse(file_path, backend, budget=unlimited)
+            if touch and parsed.is_valid:
+                parsed.pixels.tobytes()
+            latencies.append(time.perf_counter() - parse_started)
+            valid += parsed.is_valid
+            total_bytes += os.path.getsize(file_path)
+            del parsed
+        if time.perf_counter() - started > max_seconds:
+            break
+    elapsed = sum(latencies)
+    rounds = len(latencies) // len(file_paths)
+    return {
+        "backend": backend,
+        "files": len(file_paths),
+        "parses": len(latencies),
+        "valid": valid // rounds,
+        "bytes": total_bytes,
+        "seconds": elapsed,
+        "mb_per_s": total_bytes / MIB / elapsed if elapsed else None,
+        "files_per_s": len(latencies) / elapsed if elapsed else None,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "baseline_rss_bytes": baseline_rss,
+        "peak_rss_bytes": peak_rss(),
+    }
+
+
+def measure(backend, file_paths, args):
+    """
+    Runs a benchmark case in a separate process, so the peak RSS is its own
+
+    :return: dict of the measurements
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+        return executor.submit(
+            run_case, backend, file_paths, args.repeat, args.max_seconds, args.touch
+        ).result()
+
+
+def calibrate(results):
+    """
+    Derives the size thresholds of ciff_backends from the synthetic results
+
+    A backend that rejected a valid image cannot be chosen for its size,
+    however fast it was.
+
+    :param results: list of measurement dicts
+    :return: the calibration, ready to be dumped as JSON
+    """
+    fastest = {}
+    for result in results:
+        if result["corpus"] != "synthetic" or result["backend"] not in CALIBRATION_CANDIDATES:
+            continue
+        if result["valid"] < result["files"]:
+            continue
+        best = fastest.get(result["size"])
+        if best is None or result["p50_ms"] < best["p50_ms"]:
+            fastest[result["size"]] = result
+    thresholds = []
+    for size in sorted(fastest):
+        backend = fastest[size]["backend"]
+        if thresholds and thresholds[-1]["backend"] == backend:
+            thresholds[-1]["max_size"] = size
+        else:
+            thresholds.append({"max_size": size, "backend": backend})
+    if thresholds:
+        # anything larger than the largest measured size
+        thresholds[-1]["max_size"] = None
+    return {"thresholds": thresholds}
+
+
+def main():
+    parser = ArgumentParser(description="Measure the throughput and memory use of the CIFF parsers")
+    parser.add_argument("--backends", nargs="+", default=ciff_backends.available_backends(),
+                        help="backends to measure (default: all available)")
+    parser.add_argument("--test-vectors", default="test-vectors",
+                        help="directory of real images to measure")
+    parser.add_argument("--max-size", type=int, default=64 * MIB,
+                        help="largest synthetic image in bytes (up to %d)" % GIB)
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="how many times each file is parsed")
+    parser.add_argument("--max-seconds", type=float, default=30,
+                        help="stop repeating a case after this many seconds")
+    parser.add_argument("--touch", action="store_true",
+                        help="read all pixel data after parsing")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--calibration",
+                        help="write a calibration file for ciff_backends here (implies --touch)")
+    args = parser.parse_args()
+    if args.calibration:
+        # lazy backends are only comparable once they paid for the pixels
+        args.touch = True
+
+    results = []
+    with tempfile.TemporaryDirectory() as synthetic_dir:
+        corpora = []
+        if os.path.isdir(args.test_vectors) and os.listdir(args.test_vectors):
+            test_vectors = sorted(join(args.test_vectors, f) for f in os.listdir(args.test_vectors))
+            corpora.append(("test-vectors", None, test_vectors))
+        for size in SYNTHETIC_SIZES:
+            if size > args.max_size:
+                break
+            file_path = join(synthetic_dir, f"synthetic-{size_label(size)}.ciff")
+            write_synthetic_image(file_path, size)
+            corpora.append(("synthetic", size, [file_path]))
+
+        for corpus, size, file_paths in corpora:
+            for backend in args.backends:
+                result = measure(backend, file_paths, args)
+                result.update(corpus=corpus, size=size)
+                results.append(result)
+                label = f"{corpus}-{size_label(size)}" if size else corpus
+                print(
+                    f"{backend:>8} {label:<20} {result['mb_per_s'] or 0:10.1f} MB/s "
+                    f"{result['p50_ms']:10.3f} ms p50 {result['p99_ms']:10.3f} ms p99",
+                    file=sys.stderr
+                )
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.calibration:
+        with open(args.calibration, "w") as calibration_file:
+            json.dump(calibrate(results), calibration_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 #include <iostream>
 #include <fstream>
+#include <streambuf>
 #include <vector>
 #include <string>
 #include <cstdint>
@@ -8,6 +9,9 @@
 #include <cstring>
 #include <cmath>
 
+// Largest pixel payload the parser accepts, see set_max_content_size
+static int64_t max_content_size = INT64_MAX;
+
 class CIFF {
 public:
     std::string magic;
@@ -21,13 +25,17 @@ public:
     bool is_valid = true;
 
     static CIFF parse(const std::string& path) {
-        CIFF ciff;
         std::ifstream file(path, std::ios::binary);
         if (!file) {
+            CIFF ciff;
             ciff.is_valid = false;
             return ciff;
         }
+        return parse(file);
+    }
 
+    static CIFF parse(std::istream& file) {
+        CIFF ciff;
         try {
             // Read magic
             char magic_buf[4];
@@ -48,10 +56,21 @@ public:
             ciff.width = read_int64(file);
             ciff.height = read_int64(file);
             if (ciff.width < 0 || ciff.height < 0) throw std::runtime_error("Invalid dimensions");
-            if (ciff.width / 2 > pow(2, 63) - 1 || ciff.height / 2 > pow(2, 63) - 1) throw std::runtime_error("Dimensions too large");
-            // Validate content size
+            // Validate content size without overflowing width * height * 3
+            if (ciff.width != 0 && ciff.height > INT64_MAX / 3 / ciff.width)
+                throw std::runtime_error("Dimensions too large");
             if (ciff.content_size != ciff.width * ciff.height * 3)
                 throw std::runtime_error("Content size mismatch");
+            if (ciff.content_size > max_content_size)
+                throw std::runtime_error("Content size exceeds the limit");
+
+            // Check the size of the file before reading the rest of it
+            std::streampos fields_end = file.tellg();
+            file.seekg(0, std::ios::end);
+            int64_t file_size = static_cast<int64_t>(file.tellg());
+            file.seekg(fields_end);
+            if (file_size < ciff.header_size || file_size - ciff.header_size != ciff.content_size)
+                throw std::runtime_error("File size mismatch");
 
             // Read caption
             char ch;
@@ -83,7 +102,9 @@ public:
                     throw std::runtime_error("Tag must end with null character");
             }
 
-            // Read pixels
+            // Read pixels, the size of the file was checked above, so the
+            // reservation cannot exceed it
+            ciff.pixels.reserve(static_cast<size_t>(ciff.content_size / 3));
             int64_t pixel_bytes = 0;
             while (pixel_bytes < ciff.content_size) {
                 uint8_t rgb[3];
@@ -104,13 +125,40 @@ public:
     }
 
 private:
-    static int64_t read_int64(std::ifstream& file) {
+    static int64_t read_int64(std::istream& file) {
         int64_t val;
         file.read(reinterpret_cast<char*>(&val), 8);
         if (file.gcount() != 8) throw std::runtime_error("Failed to read int64");
         return val;
     }
 };
+
+// Read-only stream buffer over memory owned by the caller, so an image
+// received in memory is parsed without copying it into a stream first
+class MemoryBuffer : public std::streambuf {
+public:
+    MemoryBuffer(const char* data, size_t size) {
+        char* begin = const_cast<char*>(data);
+        setg(begin, begin, begin + size);
+    }
+
+protected:
+    pos_type seekoff(off_type off, std::ios_base::seekdir dir, std::ios_base::openmode which) override {
+        char* target;
+        if (dir == std::ios_base::beg) target = eback() + off;
+        else if (dir == std::ios_base::cur) target = gptr() + off;
+        else target = egptr() + off;
+        if (!(which & std::ios_base::in) || target < eback() || target > egptr())
+            return pos_type(off_type(-1));
+        setg(eback(), target, egptr());
+        return pos_type(target - eback());
+    }
+
+    pos_type seekpos(pos_type pos, std::ios_base::openmode which) override {
+        return seekoff(off_type(pos), std::ios_base::beg, which);
+    }
+};
+
 //int main() {
 //    std::string path = "./test-vectors/test1.ciff";
 //    CIFF ciff = CIFF::parse_ciff(path);
@@ -127,6 +175,12 @@ private:
 //
 //    return 0;
 //}
+#ifdef _WIN32
+#define CIFF_EXPORT __declspec(dllexport)
+#else
+#define CIFF_EXPORT __attribute__((visibility("default")))
+#endif
+
 extern "C" {
     struct RGBPixel {
         uint8_t r, g, b;
@@ -144,8 +198,7 @@ extern "C" {
         bool is_valid;
     };
 
-    __declspec(dllexport) CIFF_Export* parse(const char* path) {
-        CIFF ciff = CIFF::parse(path);
+    static CIFF_Export* export_ciff(const CIFF& ciff) {
         if (!ciff.is_valid) return nullptr;
 
         CIFF_Export* export_data = new CIFF_Export;
@@ -163,8 +216,8 @@ extern "C" {
         memcpy(caption_buffer, ciff.caption.c_str(), len + 1);
         export_data->caption = caption_buffer;
 
-        // Allocate tags
-        export_data->tags = new const char*[ciff.tags.size()];
+        // Allocate tags (plus the terminating nullptr)
+        export_data->tags = new const char*[ciff.tags.size() + 1];
         for (size_t i = 0; i < ciff.tags.size(); ++i) {
             len = ciff.tags[i].size();
             char* tag_buffer = new char[len + 1];
@@ -185,7 +238,22 @@ extern "C" {
         return export_data;
     }
 
-    __declspec(dllexport) void free_ciff(CIFF_Export* data) {
+    CIFF_EXPORT CIFF_Export* parse(const char* path) {
+        return export_ciff(CIFF::parse(std::string(path)));
+    }
+
+    CIFF_EXPORT CIFF_Export* parse_buffer(const char* data, int64_t size) {
+        if (!data || size < 0) return nullptr;
+        MemoryBuffer buffer(data, static_cast<size_t>(size));
+        std::istream stream(&buffer);
+        return export_ciff(CIFF::parse(stream));
+    }
+
+    CIFF_EXPORT void set_max_content_size(int64_t limit) {
+        max_content_size = limit;
+    }
+
+    CIFF_EXPORT void free_ciff(CIFF_Export* data) {
         if (!data) return;
 
         delete[] data->caption;
@@ -1,11 +1,376 @@
+import io
+import mmap
+import os
 import struct
+import sys
+import time
+from collections import namedtuple
+
+# layout of the fixed part of the header:
+# magic, header size, content size, width, height
+_FIXED_HEADER = struct.Struct("<4sqqqq")
+
+
+# bytes pulled from a stream at a time, so a forged size field cannot
+# make us allocate more memory than the data actually sent
+_STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+# phases of the parsing timed by the profiler, see set_profile_hook
+PHASE_HEADER = "header"
+PHASE_CAPTION = "caption"
+PHASE_TAGS = "tags"
+PHASE_PIXELS = "pixels"
+PHASE_TRAILING = "trailing"
+
+# statistics of a single profiled parse: phase_seconds maps the PHASE_*
+# names to the time spent in them, bytes_read and read_calls count the
+# reads of the file, mode is the mode of parse_ciff_file ("mmap": the
+# file was not read, the pixels are paged in when they are accessed)
+ParseProfile = namedtuple(
+    "ParseProfile",
+    ["path", "is_valid", "error_code", "phase_seconds", "bytes_read", "read_calls", "mode"],
+    defaults=["read"]
+)
+
+# function called with the ParseProfile of every parse, None if profiling is off
+_profile_hook = None
+
+
+# error codes telling why an image was rejected, see CIFF.error_code
+ERROR_IO = "io_error"
+ERROR_TRUNCATED_HEADER = "truncated_header"
+ERROR_BAD_MAGIC = "bad_magic"
+ERROR_HEADER_SIZE = "header_size_out_of_range"
+ERROR_CONTENT_SIZE = "content_size_out_of_range"
+ERROR_DIMENSIONS = "dimensions_out_of_range"
+ERROR_CONTENT_SIZE_MISMATCH = "content_size_mismatch"
+ERROR_NON_ASCII = "non_ascii_header"
+ERROR_MISSING_CAPTION = "missing_caption"
+ERROR_NEWLINE_IN_TAGS = "newline_in_tags"
+ERROR_UNTERMINATED_TAG = "unterminated_tag"
+ERROR_TRUNCATED_PIXELS = "truncated_pixels"
+ERROR_TRAILING_DATA = "trailing_data"
+ERROR_OVER_BUDGET = "over_budget"
+ERROR_UNKNOWN = "unknown"
+
+
+class CIFFError(Exception):
+    """
+    Raised when a CIFF image does not conform with the specification
+    """
+
+    def __init__(self, message, code=ERROR_UNKNOWN):
+        """
+        Constructor for CIFF errors
+
+        :param message: description of the problem
+        :param code: one of the ERROR_* codes
+        """
+        super().__init__(message, code)
+        self.message = message
+        self.code = code
+
+    def __str__(self):
+        return self.message
+
+
+def _error_code_of(exception):
+    """
+    Maps an exception raised while parsing to an error code
+
+    :param exception: the exception
+    :return: one of the ERROR_* codes
+    """
+    if isinstance(exception, CIFFError):
+        return exception.code
+    if isinstance(exception, OSError):
+        return ERROR_IO
+    return ERROR_UNKNOWN
+
+
+def _decode_ascii(data, field):
+    """
+    Decodes a field of the header that must only contain ASCII characters
+
+    :param data: the raw bytes of the field
+    :param field: name of the field, used in the error message
+    :return: the decoded string
+    """
+    try:
+        return data.decode('ascii')
+    except UnicodeDecodeError:
+        raise CIFFError(f"Invalid image: non-ASCII characters found in {field}", ERROR_NON_ASCII)
+
+
+def set_profile_hook(hook):
+    """
+    Turns the profiling of CIFF.parse_ciff_file on or off
+
+    While a hook is set, every parse is timed phase by phase and the hook
+    is called with its ParseProfile. Without a hook the parser runs
+    uninstrumented. The hook is global to the process.
+
+    :param hook: function taking a ParseProfile, or None to turn profiling off
+    :return: the previous hook
+    """
+    global _profile_hook
+    previous = _profile_hook
+    _profile_hook = hook
+    return previous
+
+
+class _PhaseTimer:
+    """
+    Adds up the time spent in the phases of a profiled parse
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self._phase = None
+        self._start = time.perf_counter()
+
+    def start(self, phase):
+        """
+        Ends the current phase and starts the next one
+
+        :param phase: name of the next phase, None to stop timing
+        """
+        now = time.perf_counter()
+        if self._phase is not None:
+            self.seconds[self._phase] = self.seconds.get(self._phase, 0.0) + now - self._start
+        self._phase = phase
+        self._start = now
+
+
+class _NoTimer:
+    """
+    Stands in for _PhaseTimer when profiling is off
+    """
+
+    def start(self, phase):
+        pass
+
+
+_NO_TIMER = _NoTimer()
+
+
+class _CountingReader:
+    """
+    Wraps a binary file and counts the reads and the bytes read
+    """
+
+    def __init__(self, wrapped):
+        self.bytes_read = 0
+        self.read_calls = 0
+        self._wrapped = wrapped
+
+    def read(self, size=-1):
+        data = self._wrapped.read(size)
+        self.bytes_read += len(data)
+        self.read_calls += 1
+        return data
+
+
+class PixelBuffer:
+    """
+    Holds the pixels of an image in a single contiguous buffer
+
+    The pixels are stored row by row, each pixel taking `channels`
+    consecutive bytes. Indexing, iteration and len() work on whole pixels
+    (tuples of channel values), so a PixelBuffer can be used wherever a
+    list of pixel tuples was used before, without keeping a Python object
+    per pixel alive.
+    """
+
+    __slots__ = ("_data", "_width", "_height", "_channels")
+
+    def __init__(self, data=b"", width=0, height=0, channels=3):
+        """
+        Constructor for pixel buffers
+
+        :param data: the raw pixel bytes (any object supporting the buffer
+                     protocol, e.g. bytes, bytearray, memoryview or mmap)
+        :param width: width of the image in pixels
+        :param height: height of the image in pixels
+        :param channels: number of bytes per pixel
+        """
+        self._data = memoryview(data).cast("B")
+        self._width = width
+        self._height = height
+        self._channels = channels
+        if len(self._data) != width * height * channels:
+            raise ValueError("Pixel data does not match the dimensions")
+
+    @staticmethod
+    def from_pixels(pixels, width, height, channels=3):
+        """
+        Packs a sequence of pixel tuples into a new buffer
+
+        :param pixels: iterable of pixel tuples
+        :param width: width of the image in pixels
+        :param height: height of the image in pixels
+        :param channels: number of values in each pixel tuple
+        :return: the new PixelBuffer
+        """
+        data = bytearray(width * height * channels)
+        offset = 0
+        for pixel in pixels:
+            data[offset:offset + channels] = bytes(pixel)
+            offset += channels
+        return PixelBuffer(data, width, height, channels)
+
+    @property
+    def data(self):
+        """
+        The raw pixel bytes
+
+        :return: memoryview
+        """
+        return self._data
+
+    @property
+    def width(self):
+        """
+        Width of the image in pixels
+
+        :return: int
+        """
+        return self._width
+
+    @property
+    def height(self):
+        """
+        Height of the image in pixels
+
+        :return: int
+        """
+        return self._height
+
+    @property
+    def channels(self):
+        """
+        Number of bytes per pixel
+
+        :return: int
+        """
+        return self._channels
+
+    @property
+    def stride(self):
+        """
+        Number of bytes in a row of pixels
+
+        :return: int
+        """
+        return self._width * self._channels
+
+    def row(self, y):
+        """
+        Returns a row of pixels without copying it
+
+        :param y: index of the row
+        :return: memoryview of the raw bytes of the row
+        """
+        if y < 0:
+            y += self._height
+        if not 0 <= y < self._height:
+            raise IndexError("row index out of range")
+        return self._data[y * self.stride:(y + 1) * self.stride]
+
+    def tobytes(self):
+        """
+        Copies the raw pixel bytes
+
+        :return: bytes
+        """
+        return self._data.tobytes()
+
+    def to_numpy(self):
+        """
+        Returns the pixels as a NumPy array without copying them
+
+        The array shares memory with the buffer: it is read-only if the
+        buffer is (e.g. bytes or a read-only mapping), and writes to it
+        change the pixels otherwise. NumPy is an optional dependency, it
+        is only imported when this method is called.
+
+        :return: numpy.ndarray of uint8 with the shape (height, width, channels)
+        :raises ImportError: if NumPy is not installed
+        """
+        import numpy
+        return numpy.frombuffer(self._data, dtype=numpy.uint8).reshape(
+            self._height, self._width, self._channels
+        )
+
+    def __len__(self):
+        return self._width * self._height
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("pixel index out of range")
+        offset = index * self._channels
+        return tuple(self._data[offset:offset + self._channels])
+
+    def __iter__(self):
+        # one strided view per channel, zipped together into pixel tuples
+        return zip(*(self._data[c::self._channels] for c in range(self._channels)))
+
+    def __eq__(self, other):
+        if isinstance(other, PixelBuffer):
+            return (self._width, self._height, self._channels) == \
+                (other.width, other.height, other.channels) and \
+                self._data == other.data
+        try:
+            return len(self) == len(other) and \
+                all(tuple(a) == tuple(b) for a, b in zip(self, other))
+        except TypeError:
+            return NotImplemented
+
+    def __reduce__(self):
+        # memoryviews cannot be pickled, the pixels are sent as bytes
+        return PixelBuffer, (self.tobytes(), self._width, self._height, self._channels)
+
+    def __repr__(self):
+        return f"PixelBuffer(width={self._width}, height={self._height}, channels={self._channels})"
+
+
+# the pixels of images without pixel data (e.g. probed ones), an empty
+# read-only buffer can be shared
+_NO_PIXELS = PixelBuffer()
+
+
+# immutable record of the header fields and the verdict of an image, see
+# CIFF.metadata; much smaller than a CIFF object, as it has no pixels
+CIFFMetadata = namedtuple(
+    "CIFFMetadata",
+    ["magic", "header_size", "content_size", "width", "height",
+     "caption", "tags", "is_valid", "error_code"]
+)
 
 
 class CIFF:
     """
     Holds data of a CIFF image
+
+    The fields are plain attributes stored in slots, so an instance has no
+    per-instance dictionary: magic, header_size, content_size, width,
+    height, caption, tags (a tuple of interned strings, each keeping its
+    terminating '\0'), pixels (a PixelBuffer), is_valid (whether the image
+    conforms with the specification) and error_code (one of the ERROR_*
+    codes telling why it does not, None for valid images). Use metadata
+    to get an immutable record of the header fields.
     """
 
+    __slots__ = (
+        "magic", "header_size", "content_size", "width", "height",
+        "caption", "_tags", "pixels", "is_valid", "error_code"
+    )
+
     def __init__(
             self,
             magic_chars="CIFF",
@@ -26,356 +391,824 @@ class CIFF:
         :param width_long: width of the image (8-byte-long int)
         :param height_long: height of the image (8-byte-long int)
         :param caption_string: caption of the image (string)
-        :param tags_list: list of tags in the image
-        :param pixels_list: list of pixels to display
-        """
-        self._magic = magic_chars
-        self._header_size = header_size_long
-        self._content_size = content_size_long
-        self._width = width_long
-        self._height = height_long
-        self._caption = caption_string
-        if tags_list is None:
-            self._tags = []
-        else:
-            self._tags = tags_list
+        :param tags_list: iterable of the tags in the image
+        :param pixels_list: pixels to display (PixelBuffer or list of tuples)
+        """
+        self.magic = magic_chars
+        self.header_size = header_size_long
+        self.content_size = content_size_long
+        self.width = width_long
+        self.height = height_long
+        self.caption = caption_string
+        self.tags = () if tags_list is None else tags_list
         if pixels_list is None:
-            self._pixels = []
+            self.pixels = _NO_PIXELS
         else:
-            self._pixels = pixels_list
-        self._is_valid = True
+            self.pixels = pixels_list
+        self.is_valid = True
+        self.error_code = None
+
+    @property
+    def tags(self):
+        """
+        The tags of the image, each keeping its terminating '\0'
+
+        The tags are interned, so the many images sharing a tag also share
+        a single copy of it.
+
+        :return: tuple of strings
+        """
+        return self._tags
+
+    @tags.setter
+    def tags(self, value):
+        self._tags = tuple(sys.intern(tag) for tag in value)
+
+    @property
+    def metadata(self):
+        """
+        Immutable record of the header fields and the verdict
+
+        :return: CIFFMetadata
+        """
+        return CIFFMetadata(
+            self.magic, self.header_size, self.content_size, self.width, self.height,
+            self.caption, self._tags, self.is_valid, self.error_code
+        )
+
+    def to_numpy(self):
+        """
+        Returns the pixels as a NumPy array sharing memory with them
+
+        See PixelBuffer.to_numpy, pixels given as a list of tuples are
+        copied into a buffer first.
+
+        :return: numpy.ndarray of uint8 with the shape (height, width, 3)
+        :raises ImportError: if NumPy is not installed
+        """
+        pixels = self.pixels
+        if not isinstance(pixels, PixelBuffer):
+            pixels = PixelBuffer.from_pixels(pixels, self.width, self.height)
+        return pixels.to_numpy()
 
     #
-    # Properties
+    # Serialization
     #
 
-    @property
-    def is_valid(self):
+    def to_bytes(self):
         """
-        A flag indicating whether the the CIFF image conforms
-        with the specification or not
+        Serializes the image into the CIFF format
+
+        The header size and the content size are computed from the
+        caption, the tags and the dimensions of the image.
 
-        :return: boolean
+        :return: bytes
         """
-        return self._is_valid
+        output = io.BytesIO()
+        self._write(output)
+        return output.getvalue()
 
-    @is_valid.setter
-    def is_valid(self, value):
-        self._is_valid = value
+    def write(self, file_path):
+        """
+        Writes the image into a CIFF file
 
-    @property
-    def magic(self):
+        :param file_path: path of the file to create (string)
+        :return: the number of bytes written
         """
-        The parsed magic characters
+        with open(file_path, "wb") as ciff_file:
+            return self._write(ciff_file)
+
+    def _write(self, output):
+        pixels = self.pixels
+        if not isinstance(pixels, PixelBuffer):
+            pixels = PixelBuffer.from_pixels(pixels, self.width, self.height)
+        return CIFF.write_ciff(output, self.width, self.height, pixels, self.caption, self.tags)
 
-        :return: str
+    #
+    # Static methods
+    #
+
+    @staticmethod
+    def parse_ciff_file(file_path, mode="read"):
         """
-        return self._magic
+        Parses a CIFF file and constructs the corresponding object
 
-    @magic.setter
-    def magic(self, value):
-        self._magic = value
+        In "read" mode the fixed part of the header, the caption and tags
+        and the pixel data are each pulled in with a single read, so the
+        cost of the parsing is dominated by the I/O instead of per-byte
+        Python calls.
 
-    @property
-    def header_size(self):
+        In "mmap" mode the file is memory-mapped instead: the header is
+        validated against the mapping and the pixels are a zero-copy view
+        into it, so they are only paged in when they are actually accessed.
+        The file must not be truncated while the returned object is in use.
+
+        :param file_path: path the to file to be parsed (string)
+        :param mode: "read" or "mmap"
+        :return: the parsed CIFF object
         """
-        The parsed header size
+        if mode == "mmap":
+            return CIFF._parse_mapped_file(file_path)
+        if mode != "read":
+            raise ValueError(f"Unknown parse mode: {mode}")
 
-        :return: int
+        hook = _profile_hook
+        timer = _NO_TIMER if hook is None else _PhaseTimer()
+        reader = None
+        new_ciff = CIFF()
+        try:
+            with open(file_path, "rb") as ciff_file:
+                # the size of the file bounds every bulk read below, so a
+                # forged size field cannot make us allocate huge buffers
+                file_size = os.fstat(ciff_file.fileno()).st_size
+                if hook is not None:
+                    ciff_file = reader = _CountingReader(ciff_file)
+                timer.start(PHASE_HEADER)
+                CIFF._read_fixed_header(new_ciff, ciff_file, file_size)
+                header_rest = CIFF._read_header_rest(new_ciff, ciff_file)
+                CIFF._parse_caption_and_tags(new_ciff, header_rest, timer)
+
+                # read the pixels
+                timer.start(PHASE_PIXELS)
+                content = ciff_file.read(new_ciff.content_size)
+                if len(content) != new_ciff.content_size:
+                    raise CIFFError("Invalid image: pixel data not found", ERROR_TRUNCATED_PIXELS)
+                new_ciff.pixels = PixelBuffer(content, new_ciff.width, new_ciff.height)
+
+                # we should have reached the end of the file
+                timer.start(PHASE_TRAILING)
+                if ciff_file.read(1):
+                    raise CIFFError("Invalid image: extra data found after pixel data", ERROR_TRAILING_DATA)
+
+        except Exception as e:
+            new_ciff.is_valid = False
+            new_ciff.error_code = _error_code_of(e)
+
+        if hook is not None:
+            CIFF._report_profile(hook, file_path, new_ciff, timer, reader, mode)
+        return new_ciff
+
+    @staticmethod
+    def parse_ciff_bytes(buffer):
         """
-        return self._header_size
+        Parses a CIFF image held in memory
 
-    @header_size.setter
-    def header_size(self, value):
-        self._header_size = value
+        The same checks are run as by parse_ciff_file. Only the header is
+        copied, the pixels of the returned object are a view into the
+        buffer, so a mutable buffer must not be changed while the object
+        is in use.
 
-    @property
-    def content_size(self):
+        :param buffer: the whole image (bytes, bytearray, memoryview or any
+                       object supporting the buffer protocol)
+        :return: the parsed CIFF object
         """
-        The parsed content size
+        new_ciff = CIFF()
+        try:
+            CIFF._parse_buffer(new_ciff, buffer)
 
-        :return: int
+        except Exception as e:
+            new_ciff.is_valid = False
+            new_ciff.error_code = _error_code_of(e)
+
+        return new_ciff
+
+    @staticmethod
+    def parse_ciff_stream(fileobj):
         """
-        return self._content_size
+        Parses a CIFF image read from a binary stream
 
-    @content_size.setter
-    def content_size(self, value):
-        self._content_size = value
+        The stream is read until its end, so pipes and sockets work as well
+        as files; it is neither seeked nor closed. As the size of the data is
+        not known in advance, the reads are done in chunks of bounded size
+        and a stream ending early or holding extra data after the pixels is
+        only noticed when it is reached. The verdict is the same as the one
+        of parse_ciff_file, but for an image with several problems the
+        error_code may name a different one.
 
-    @property
-    def width(self):
+        :param fileobj: binary stream to read from (anything with a read method)
+        :return: the parsed CIFF object
         """
-        The parsed width of the image
+        new_ciff = CIFF()
+        try:
+            fixed_header = CIFF._read_stream(fileobj, _FIXED_HEADER.size)
+            if len(fixed_header) != _FIXED_HEADER.size:
+                raise CIFFError("Invalid image: header not found", ERROR_TRUNCATED_HEADER)
+            CIFF._parse_fixed_header(new_ciff, fixed_header)
 
-        :return: int
+            # read the caption and the tags (the rest of the header)
+            header_rest_size = new_ciff.header_size - _FIXED_HEADER.size
+            header_rest = CIFF._read_stream(fileobj, header_rest_size)
+            if len(header_rest) != header_rest_size:
+                raise CIFFError("Invalid image: header size exceeds file size", ERROR_TRUNCATED_HEADER)
+            CIFF._parse_caption_and_tags(new_ciff, bytes(header_rest))
+
+            # read the pixels
+            content = CIFF._read_stream(fileobj, new_ciff.content_size)
+            if len(content) != new_ciff.content_size:
+                raise CIFFError("Invalid image: pixel data not found", ERROR_TRUNCATED_PIXELS)
+            new_ciff.pixels = PixelBuffer(content, new_ciff.width, new_ciff.height)
+
+            # we should have reached the end of the stream
+            if CIFF._read_stream(fileobj, 1):
+                raise CIFFError("Invalid image: extra data found after pixel data", ERROR_TRAILING_DATA)
+
+        except Exception as e:
+            new_ciff.is_valid = False
+            new_ciff.error_code = _error_code_of(e)
+
+        return new_ciff
+
+    @staticmethod
+    def _report_profile(hook, file_path, new_ciff, timer, reader, mode):
         """
-        return self._width
+        Calls the profile hook with the statistics of a finished parse
 
-    @width.setter
-    def width(self, value):
-        self._width = value
+        :param hook: function called with the ParseProfile of the parse
+        :param file_path: path of the parsed file
+        :param new_ciff: the parsed CIFF object
+        :param timer: the _PhaseTimer of the parse
+        :param reader: the _CountingReader the file was read through, None
+                       if it was not read
+        :param mode: "read" or "mmap"
+        """
+        timer.start(None)
+        hook(ParseProfile(
+            file_path, new_ciff.is_valid, new_ciff.error_code, timer.seconds,
+            reader.bytes_read if reader is not None else 0,
+            reader.read_calls if reader is not None else 0,
+            mode
+        ))
 
-    @property
-    def height(self):
+    @staticmethod
+    def precheck(file_path):
         """
-        The parsed height of the image
+        Runs the cheap checks of the validation only
 
-        :return: int
+        Only the first 36 bytes are read: the magic, the size fields, the
+        relation of the content size and the dimensions, and the size of
+        the file are checked. A file failing these checks is surely
+        invalid, one passing them still needs to be parsed or probed.
+
+        :param file_path: path the to file to be checked (string)
+        :return: the CIFF object holding the size fields of the image,
+                 its error_code tells why it was rejected
         """
-        return self._height
+        new_ciff = CIFF()
+        try:
+            with open(file_path, "rb") as ciff_file:
+                file_size = os.fstat(ciff_file.fileno()).st_size
+                CIFF._read_fixed_header(new_ciff, ciff_file, file_size)
 
-    @height.setter
-    def height(self, value):
-        self._height = value
+        except Exception as e:
+            new_ciff.is_valid = False
+            new_ciff.error_code = _error_code_of(e)
 
-    @property
-    def caption(self):
+        return new_ciff
+
+    @staticmethod
+    def probe(file_path):
         """
-        The parsed image caption
+        Parses only the header of a CIFF file
 
-        :return: str
+        The pixel data is not read: its presence is checked by comparing
+        the size of the file with header_size + content_size, so probing
+        costs the same for a tiny and for a huge image. The returned object
+        has the same is_valid verdict as parse_ciff_file would give, but
+        its pixels are left empty.
+
+        :param file_path: path the to file to be probed (string)
+        :return: the CIFF object holding the metadata of the image
         """
-        return self._caption
+        new_ciff = CIFF()
+        try:
+            with open(file_path, "rb") as ciff_file:
+                # the size of the file is checked against the header
+                # as a part of reading it
+                file_size = os.fstat(ciff_file.fileno()).st_size
+                CIFF._read_header(new_ciff, ciff_file, file_size)
 
-    @caption.setter
-    def caption(self, value):
-        self._caption = value
+        except Exception as e:
+            new_ciff.is_valid = False
+            new_ciff.error_code = _error_code_of(e)
 
-    @property
-    def tags(self):
+        return new_ciff
+
+    @staticmethod
+    def iter_rows(file_path):
         """
-        The parsed list of tags
+        Validates a CIFF file and yields its pixel data row by row
+
+        Only one row is held in memory at a time, so images of any height
+        can be hashed, converted or inspected in constant memory. Use
+        probe() to learn the dimensions of the image beforehand. Images
+        with a width of 0 have no pixel data, so no rows are yielded.
+
+        The header and the size of the file are checked before the first
+        row is yielded. The reads are still checked while streaming, in
+        case the file changes in the meantime.
 
-        :return: list of strings
+        :param file_path: path the to file to be read (string)
+        :return: generator of the rows, each holding width*3 bytes
+        :raises CIFFError: if the image is not valid
         """
-        return self._tags
+        new_ciff = CIFF()
+        with open(file_path, "rb") as ciff_file:
+            file_size = os.fstat(ciff_file.fileno()).st_size
+            CIFF._read_header(new_ciff, ciff_file, file_size)
 
-    @tags.setter
-    def tags(self, value):
-        self._tags = value
+            row_size = new_ciff.width * 3
+            rows = new_ciff.height if row_size else 0
+            for _ in range(rows):
+                row = ciff_file.read(row_size)
+                if len(row) != row_size:
+                    raise CIFFError("Invalid image: pixel data not found", ERROR_TRUNCATED_PIXELS)
+                yield row
 
-    @property
-    def pixels(self):
+            # we should have reached the end of the file
+            if ciff_file.read(1):
+                raise CIFFError("Invalid image: extra data found after pixel data", ERROR_TRAILING_DATA)
+
+    @staticmethod
+    def write_ciff(output, width, height, pixels, caption="", tags=()):
         """
-        The parsed pixels
+        Writes a CIFF image into a binary stream
+
+        The header is assembled in memory, the pixels are written straight
+        from the given buffer or rows, without an intermediate copy. To
+        stream an image of any size, pass a generator of rows, e.g. the one
+        returned by iter_rows().
 
-        :return: list
+        :param output: binary stream to write to (anything with a write method)
+        :param width: width of the image in pixels
+        :param height: height of the image in pixels
+        :param pixels: the RGB pixel data: a PixelBuffer, an object supporting
+                       the buffer protocol, or an iterable of rows of width*3 bytes
+        :param caption: caption of the image, must not contain '\n'
+        :param tags: iterable of tags, must not contain '\n' or '\0' (a single
+                     trailing '\0', as kept by parse_ciff_file, is accepted)
+        :return: the number of bytes written
+        :raises ValueError: if the fields or the amount of pixel data are not valid
         """
-        return self._pixels
+        if width < 0 or height < 0:
+            raise ValueError("Image dimensions must not be negative")
+        if '\n' in caption:
+            raise ValueError("Caption must not contain newline characters")
+        tag_data = ""
+        for tag in tags:
+            if tag.endswith('\0'):
+                tag = tag[:-1]
+            if '\n' in tag or '\0' in tag:
+                raise ValueError("Tags must not contain newline or null characters")
+            tag_data += tag + '\0'
+        try:
+            header_rest = (caption + '\n' + tag_data).encode('ascii')
+        except UnicodeEncodeError:
+            raise ValueError("Caption and tags must only contain ASCII characters")
+        header_size = _FIXED_HEADER.size + len(header_rest)
+        content_size = width * height * 3
+        if header_size < 38:
+            # the header must end with a null character
+            raise ValueError("At least one tag is needed when the caption is empty")
 
-    @pixels.setter
-    def pixels(self, value):
-        self._pixels = value
+        if isinstance(pixels, PixelBuffer):
+            pixels = pixels.data
+        try:
+            content = memoryview(pixels).cast("B")
+        except TypeError:
+            # not a buffer, so an iterable of rows
+            content = None
+        if content is not None and len(content) != content_size:
+            raise ValueError("Pixel data does not match the dimensions")
 
-    #
-    # Static methods
-    #
+        output.write(_FIXED_HEADER.pack(b"CIFF", header_size, content_size, width, height))
+        output.write(header_rest)
+        if content is not None:
+            output.write(content)
+        else:
+            row_size = width * 3
+            rows = 0
+            for row in pixels:
+                # checked before writing, so the output never exceeds the
+                # declared content size, and an endless iterator stops
+                if rows == height:
+                    raise ValueError("Number of pixel rows does not match the height")
+                row = memoryview(row).cast("B")
+                if len(row) != row_size:
+                    raise ValueError("Pixel row does not match the width")
+                output.write(row)
+                rows += 1
+            if rows != height and row_size:
+                raise ValueError("Number of pixel rows does not match the height")
+        return header_size + content_size
 
     @staticmethod
-    def parse_ciff_file(file_path):
+    def _read_header(new_ciff, ciff_file, file_size):
         """
-        Parses a CIFF file and constructs the corresponding object
+        Reads and validates the whole header of a CIFF file
+
+        :param new_ciff: the CIFF object to fill in
+        :param ciff_file: the file opened in binary mode, positioned at its start
+        :param file_size: the size of the file in bytes
+        """
+        CIFF._read_fixed_header(new_ciff, ciff_file, file_size)
+        CIFF._parse_caption_and_tags(new_ciff, CIFF._read_header_rest(new_ciff, ciff_file))
 
-        TODO: make sure that malformed input cannot crash the parsing method
+    @staticmethod
+    def _read_header_rest(new_ciff, ciff_file):
+        """
+        Reads the caption and the tags (the rest of the header)
+
+        :param new_ciff: the CIFF object with the size fields filled in
+        :param ciff_file: the file opened in binary mode, positioned after the size fields
+        :return: the header bytes following the size fields
+        """
+        header_rest_size = new_ciff.header_size - _FIXED_HEADER.size
+        header_rest = ciff_file.read(header_rest_size)
+        if len(header_rest) != header_rest_size:
+            raise CIFFError("Invalid image: header not found", ERROR_TRUNCATED_HEADER)
+        return header_rest
+
+    @staticmethod
+    def _read_fixed_header(new_ciff, ciff_file, file_size):
+        """
+        Reads and validates the magic and the size fields of a CIFF file
+
+        :param new_ciff: the CIFF object to fill in
+        :param ciff_file: the file opened in binary mode, positioned at its start
+        :param file_size: the size of the file in bytes
+        """
+        # read the magic bytes and the four size fields at once
+        fixed_header = ciff_file.read(_FIXED_HEADER.size)
+        # read may not return the requested number of bytes
+        if len(fixed_header) != _FIXED_HEADER.size:
+            raise CIFFError("Invalid image: header not found", ERROR_TRUNCATED_HEADER)
+        CIFF._parse_fixed_header(new_ciff, fixed_header)
+        CIFF._check_file_size(new_ciff, file_size)
+
+    @staticmethod
+    def _check_file_size(new_ciff, file_size):
+        """
+        Checks the size of the file against the size fields of the header
+
+        :param new_ciff: the CIFF object with the size fields filled in
+        :param file_size: the size of the file in bytes
+        """
+        if file_size < new_ciff.header_size:
+            raise CIFFError("Invalid image: header size exceeds file size", ERROR_TRUNCATED_HEADER)
+        if file_size - new_ciff.header_size < new_ciff.content_size:
+            raise CIFFError("Invalid image: pixel data not found", ERROR_TRUNCATED_PIXELS)
+        if file_size - new_ciff.header_size > new_ciff.content_size:
+            raise CIFFError("Invalid image: extra data found after pixel data", ERROR_TRAILING_DATA)
+
+    @staticmethod
+    def _read_stream(fileobj, size):
+        """
+        Reads up to size bytes from a stream, stopping early at its end
+
+        :param fileobj: binary stream to read from
+        :param size: the number of bytes to read
+        :return: bytearray of at most size bytes
+        """
+        data = bytearray()
+        while len(data) < size:
+            # pipes and sockets may return fewer bytes than requested
+            chunk = fileobj.read(min(size - len(data), _STREAM_CHUNK_SIZE))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    @staticmethod
+    def _parse_mapped_file(file_path):
+        """
+        Parses a CIFF file through a read-only memory mapping
 
         :param file_path: path the to file to be parsed (string)
         :return: the parsed CIFF object
         """
+        hook = _profile_hook
+        timer = _NO_TIMER if hook is None else _PhaseTimer()
         new_ciff = CIFF()
-        bytes_read = 0
-        # the following code can throw Exceptions at multiple lines
-        # TODO: surround the parsing code with a try-except block and
-        # TODO: set the is_valid property to False
-        # TODO: if an Exception has been raised
         try:
+            timer.start(PHASE_HEADER)
             with open(file_path, "rb") as ciff_file:
-                # read the magic bytes
-                magic = ciff_file.read(4)
-                # read may not return the requested number of bytes
-                # TODO: magic must contain 4 bytes. If not, raise Exception
-                #if len(magic) != ____:
-                #    raise Exception(____)
-                if len(magic) != 4:
-                    raise Exception("Invalid image: magic bytes not found")
-                bytes_read += 4
-                # decode the bytes as 4 characters
-                new_ciff.magic = magic.decode('ascii')
-                # TODO: the magic must be "CIFF". If not, raise Exception
-                #if new_ciff.magic != ____:
-                #    new_ciff.is_valid = ____
-                #    raise ____
-                if new_ciff.magic != "CIFF":
-                    new_ciff.is_valid = False
-                    raise Exception("Invalid image: magic bytes do not match")
-                # read the header size
-                h_size = ciff_file.read(8)
-                # TODO: h_size must contain 8 bytes. If not, raise Exception
-                #if len(____) != ____:
-                #    raise ____
-                if len(h_size) != 8:
-                    raise Exception("Invalid image: header size not found")
-                bytes_read += 8
-                # interpret the bytes as an 8-byte-long integer
-                # unpack returns a list
-                # HINT: check the "q" format specifier!
-                # HINT: Does it fit our purposes?
-                new_ciff.header_size = struct.unpack("q", h_size)[0]
-                # the header size must be in [38, 2^64 - 1]
-                # TODO: check the value range. If not in range, raise Exception
-                #if new_ciff.header_size < ____ \
-                #        or new_ciff.header_size > ____:
-                #    ____
-                if new_ciff.header_size < 38 or new_ciff.header_size > 2**64 - 1:
-                    raise Exception("Invalid image: header size out of range")
-                # read the content size
-                c_size = ciff_file.read(8)
-                # TODO: c_size must contain 8 bytes. If not, raise Exception
-                #if len(____) != ____:
-                #    ____
-                if len(c_size) != 8:
-                    raise Exception("Invalid image: content size not found")
-                bytes_read += 8
-                # interpret the bytes as an 8-byte-long integer
-                # HINT: check out the "q" format specifier!
-                # HINT: Does it fit our purposes?
-                new_ciff.content_size = struct.unpack("q", c_size)[0]
-                # the content size must be in [0, 2^64 - 1]
-                # TODO: check the value range. If not in range, raise Exception
-                # Question: is this check necessary?
-                #if new_ciff.content_size < ____ or \
-                #        new_ciff.content_size > ____:
-                #    ____
-                if new_ciff.content_size < 0 or new_ciff.content_size > 2**64 - 1:
-                    raise Exception("Invalid image: content size out of range")
-
-                # read the width
-                width = ciff_file.read(8)
-                # TODO: check if width contains 8 bytes
-                #if ____ != ____:
-                #    ____
-                if len(width) != 8:
-                    raise Exception("Invalid image: width not found")
-                bytes_read += 8
-                # interpret the bytes as an 8-byte-long integer
-                # HINT: check out the "q" format specifier!
-                # HINT: Does it fit our purposes?
-                new_ciff.width = struct.unpack("q", width)[0]
-                # the width must be in [0, 2^64 - 1]
-                # TODO: check the value range. If not in range, raise Exception
-                # Question: is this check necessary?
-                #if ____:
-                #    ____
-                if new_ciff.width < 0 or new_ciff.width > 2**64 - 1:
-                    raise Exception("Invalid image: width out of range")
-                # read the height
-                height = ciff_file.read(8)
-                # TODO: check if height contains 8 bytes
-                #if ____:
-                #    ____
-                if len(height) != 8:
-                    raise Exception("Invalid image: height not found")
-                bytes_read += 8
-                # interpret the bytes as an 8-byte-long integer
-                # HINT: check out the "q" format specifier!
-                # HINT: Does it fit our purposes?
-                new_ciff.height = struct.unpack("q", height)[0]
-                # the height must be in [0, 2^64 - 1]
-                # TODO: check the value range
-                # Question: is this check necessary?
-                #____
-                #    ____
-                if new_ciff.height < 0 or new_ciff.height > 2**64 - 1:
-                    raise Exception("Invalid image: height out of range")
-                # TODO: content size must equal width*height*3
-                #if ____:
-                #    ____
-                if new_ciff.content_size != new_ciff.width * new_ciff.height * 3:
-                    raise Exception("Invalid image: content size does not match dimensions")
-                # read the name of the image character by character
-                caption = ""
-                c = ciff_file.read(1)
-                # TODO: check if c contains 1 byte
-                #___
-                #    ____
-                if len(c) != 1:
-                    raise Exception("Invalid image: caption not found")
-                bytes_read += 1
-                char = c.decode('ascii')
-                # read until the first '\n' (caption cannot contain '\n')
-                while char != '\n':
-                    # append read character to caption
-                    caption += char
-                    # read next character
-                    c = ciff_file.read(1)
-                    # TODO: check if c contains 1 byte
-                    #___
-                    #    ____
-                    if len(c) != 1:
-                        raise Exception("Invalid image: caption not found")
-                    bytes_read += 1
-                    char = c.decode('ascii')
-                new_ciff.caption = caption
-
-                # read all the tags
-                tags = list()
-                # read until the end of the header
-                tag = ""
-                while bytes_read != new_ciff.header_size:
-                    c = ciff_file.read(1)
-                    # TODO: check if c contains 1 byte
-                    if len(c) != 1:
-                        raise Exception("Invalid image")
-                    bytes_read += 1
-                    char = c.decode('ascii')
-                    # tags should not contain '\n'
-                    # TODO: char must not be a '\n'
-                    #if ____ == ____:
-                    #    ____
-                    if char == '\n':
-                        raise Exception("Invalid image: tags must not contain newline characters")
-                    # tags are separated by terminating nulls
-                    tag += char
-                    if char == '\0':
-                        tags.append(tag)
-                        tag = ""
-                    # the very last character in the header must be a '\0'
-                    # TODO: check the last character of the header
-                    #if (bytes_read == ____) and ____:
-                    #    ____
-                    if (bytes_read == new_ciff.header_size) and (char != '\0'):
-                        raise Exception("Invalid image: header must end with a null character")
-
-                # all tags must end with '\0'
-                # TODO: check the end of each tag for the '\0'
-                #for tag in tags:
-                #    if tag[____] != ____:
-                #        ____
-                for tag in tags:
-                    if tag[-1] != '\0':
-                        raise Exception("Invalid image: tags must end with a null character")
-                new_ciff.tags = tags
-
-                # read the pixels
-                while bytes_read < new_ciff.header_size+new_ciff.content_size:
-                    c = ciff_file.read(3)
-                    # TODO: check if c contains 3 bytes
-                    #___
-                    #    ____
-                    if len(c) != 3:
-                        raise Exception("Invalid image: pixel data not found")
-                    bytes_read += 3
-                    pixel = struct.unpack("BBB", c)
-                    new_ciff.pixels.append(pixel)
-
-                # we should have reached the end of the file
-                # TODO: try to read a byte. If successful, raise Exception
-                #____
-                #____
-                #    ____
-                if ciff_file.read(1):
-                    raise Exception("Invalid image: extra data found after pixel data")
+                # an empty file cannot be mapped
+                if os.fstat(ciff_file.fileno()).st_size == 0:
+                    raise CIFFError("Invalid image: header not found", ERROR_TRUNCATED_HEADER)
+                # the mapping stays valid after the file is closed
+                mapping = mmap.mmap(ciff_file.fileno(), 0, access=mmap.ACCESS_READ)
+            CIFF._parse_buffer(new_ciff, mapping, timer)
 
         except Exception as e:
             new_ciff.is_valid = False
+            new_ciff.error_code = _error_code_of(e)
 
+        if hook is not None:
+            CIFF._report_profile(hook, file_path, new_ciff, timer, None, "mmap")
         return new_ciff
+
+    @staticmethod
+    def _parse_buffer(new_ciff, buffer, timer=_NO_TIMER):
+        """
+        Validates a complete CIFF image held in a buffer
+
+        Only the header is copied out of the buffer, the pixels of the
+        parsed object are a view into it.
+
+        :param new_ciff: the CIFF object to fill in
+        :param buffer: the whole image (any object supporting the buffer protocol)
+        :param timer: the _PhaseTimer of a profiled parse
+        """
+        timer.start(PHASE_HEADER)
+        data = memoryview(buffer).cast("B")
+        if len(data) < _FIXED_HEADER.size:
+            raise CIFFError("Invalid image: header not found", ERROR_TRUNCATED_HEADER)
+        CIFF._parse_fixed_header(new_ciff, data[:_FIXED_HEADER.size])
+        CIFF._check_file_size(new_ciff, len(data))
+
+        # the caption and the tags (the rest of the header)
+        CIFF._parse_caption_and_tags(
+            new_ciff,
+            data[_FIXED_HEADER.size:new_ciff.header_size].tobytes(),
+            timer
+        )
+
+        # the pixels fill the rest of the buffer
+        timer.start(PHASE_PIXELS)
+        new_ciff.pixels = PixelBuffer(
+            data[new_ciff.header_size:],
+            new_ciff.width,
+            new_ciff.height
+        )
+
+    @staticmethod
+    def _parse_fixed_header(new_ciff, fixed_header):
+        """
+        Validates the magic and the size fields of a CIFF header
+
+        :param new_ciff: the CIFF object to fill in
+        :param fixed_header: the first 36 bytes of the file (bytes-like)
+        """
+        magic, header_size, content_size, width, height = \
+            _FIXED_HEADER.unpack(fixed_header)
+        # the raw bytes are compared, so a non-ASCII magic is a bad magic
+        # too; it is kept with the undecodable bytes replaced
+        new_ciff.magic = magic.decode('ascii', 'replace')
+        if magic != b"CIFF":
+            new_ciff.is_valid = False
+            raise CIFFError("Invalid image: magic bytes do not match", ERROR_BAD_MAGIC)
+        # the header size must be in [38, 2^64 - 1]
+        new_ciff.header_size = header_size
+        if new_ciff.header_size < 38 or new_ciff.header_size > 2**64 - 1:
+            raise CIFFError("Invalid image: header size out of range", ERROR_HEADER_SIZE)
+        # the content size must be in [0, 2^64 - 1]
+        new_ciff.content_size = content_size
+        if new_ciff.content_size < 0 or new_ciff.content_size > 2**64 - 1:
+            raise CIFFError("Invalid image: content size out of range", ERROR_CONTENT_SIZE)
+        # the width must be in [0, 2^64 - 1]
+        new_ciff.width = width
+        if new_ciff.width < 0 or new_ciff.width > 2**64 - 1:
+            raise CIFFError("Invalid image: width out of range", ERROR_DIMENSIONS)
+        # the height must be in [0, 2^64 - 1]
+        new_ciff.height = height
+        if new_ciff.height < 0 or new_ciff.height > 2**64 - 1:
+            raise CIFFError("Invalid image: height out of range", ERROR_DIMENSIONS)
+        # content size must equal width*height*3 (Python integers do not
+        # overflow, so a forged width and height cannot wrap around)
+        if new_ciff.content_size != new_ciff.width * new_ciff.height * 3:
+            raise CIFFError("Invalid image: content size does not match dimensions", ERROR_CONTENT_SIZE_MISMATCH)
+
+    @staticmethod
+    def _parse_caption_and_tags(new_ciff, header_rest, timer=_NO_TIMER):
+        """
+        Validates and extracts the caption and the tags of a CIFF header
+
+        :param new_ciff: the CIFF object to fill in
+        :param header_rest: the header bytes following the size fields (bytes)
+        :param timer: the _PhaseTimer of a profiled parse
+        """
+        timer.start(PHASE_CAPTION)
+        caption_end = CIFF._parse_caption(new_ciff, header_rest)
+        timer.start(PHASE_TAGS)
+        CIFF._parse_tags(new_ciff, header_rest[caption_end + 1:])
+
+    @staticmethod
+    def _parse_caption(new_ciff, header_rest):
+        """
+        Validates and extracts the caption of a CIFF header
+
+        :param new_ciff: the CIFF object to fill in
+        :param header_rest: the header bytes following the size fields (bytes)
+        :return: the index of the '\n' ending the caption
+        """
+        # the caption lasts until the first '\n' (caption cannot contain '\n')
+        # and it must end within the header
+        caption_end = header_rest.find(b"\n")
+        if caption_end == -1:
+            raise CIFFError("Invalid image: caption not found", ERROR_MISSING_CAPTION)
+        new_ciff.caption = _decode_ascii(header_rest[:caption_end], "caption")
+        return caption_end
+
+    @staticmethod
+    def _parse_tags(new_ciff, tag_bytes):
+        """
+        Validates and extracts the tags of a CIFF header
+
+        :param new_ciff: the CIFF object to fill in
+        :param tag_bytes: the header bytes following the caption (bytes)
+        """
+        tags = list()
+        tag_data = _decode_ascii(tag_bytes, "tags")
+        if tag_data:
+            # tags should not contain '\n'
+            if '\n' in tag_data:
+                raise CIFFError("Invalid image: tags must not contain newline characters", ERROR_NEWLINE_IN_TAGS)
+            # the very last character in the header must be a '\0'
+            if tag_data[-1] != '\0':
+                raise CIFFError("Invalid image: header must end with a null character", ERROR_UNTERMINATED_TAG)
+            # tags are separated by terminating nulls, which are kept
+            tags = [tag + '\0' for tag in tag_data.split('\0')[:-1]]
+        new_ciff.tags = tags
+
+
+# states of CIFFPushParser: the part of the image the next byte belongs to
+_PUSH_FIXED_HEADER = "fixed_header"
+_PUSH_CAPTION_AND_TAGS = "caption_and_tags"
+_PUSH_PIXELS = "pixels"
+_PUSH_END = "end"
+_PUSH_CLOSED = "closed"
+
+
+class CIFFPushParser:
+    """
+    Incremental CIFF parser that is fed the image chunk by chunk
+
+    The bytes are validated as they arrive, by the same rules as
+    CIFF.parse_ciff_file: a bad magic is rejected at the first wrong byte,
+    the size fields once the first 36 bytes are in, and non-ASCII bytes in
+    the caption or the tags and newlines in the tags as soon as they are
+    seen. Once the input is rejected the rest of it is not looked at, so
+    an upload can be aborted early without buffering it.
+
+        parser = CIFFPushParser()
+        for chunk in chunks:
+            parser.feed(chunk)
+        ciff = parser.close()
+
+    Only problems that need the end of the input (e.g. missing pixel data
+    or a header not ending with a null character) are reported by close(),
+    unless the total size of the input is known in advance: then the size
+    fields are checked against it like against the size of a file, right
+    after the first 36 bytes.
+    The verdict is the same as the one of parse_ciff_file, but for an image
+    with several problems the error code may name a different one.
+    """
+
+    def __init__(self, keep_pixels=True, expected_size=None):
+        """
+        Constructor for push parsers
+
+        :param keep_pixels: collect the pixel data, otherwise it is only
+                            counted and the parsed image has no pixels
+        :param expected_size: the number of bytes that will be fed, e.g.
+                              the Content-Length of an upload, or None
+        """
+        self._keep_pixels = keep_pixels
+        self._expected_size = expected_size
+        self._ciff = CIFF()
+        self._state = _PUSH_FIXED_HEADER
+        # the fixed header, then the caption and the tags
+        self._header = bytearray()
+        self._pixels = bytearray()
+        # bytes still expected in the current state
+        self._remaining = _FIXED_HEADER.size
+        self._caption_end = None
+        self._error = None
+
+    @property
+    def result(self):
+        """
+        The image parsed so far
+
+        The fields are filled in as their bytes arrive. After a rejection
+        its is_valid flag is False and its error_code tells why.
+
+        :return: CIFF object
+        """
+        return self._ciff
+
+    def feed(self, chunk):
+        """
+        Validates the next chunk of the image
+
+        :param chunk: the next bytes of the image (bytes-like)
+        :raises CIFFError: if the image is not valid, also on every call
+                           after the input was rejected
+        """
+        if self._error is not None:
+            raise self._error
+        if self._state == _PUSH_CLOSED:
+            raise ValueError("Cannot feed a closed parser")
+        data = memoryview(chunk).cast("B")
+        try:
+            while data:
+                if self._state == _PUSH_FIXED_HEADER:
+                    data = self._feed_fixed_header(data)
+                elif self._state == _PUSH_CAPTION_AND_TAGS:
+                    data = self._feed_caption_and_tags(data)
+                elif self._state == _PUSH_PIXELS:
+                    data = self._feed_pixels(data)
+                else:
+                    raise CIFFError("Invalid image: extra data found after pixel data", ERROR_TRAILING_DATA)
+        except CIFFError as e:
+            self._reject(e)
+            raise
+
+    def close(self):
+        """
+        Signals the end of the input and finishes the validation
+
+        :return: the parsed CIFF object
+        :raises CIFFError: if the image is not valid
+        """
+        if self._error is not None:
+            raise self._error
+        if self._state == _PUSH_CLOSED:
+            return self._ciff
+        try:
+            if self._state in (_PUSH_FIXED_HEADER, _PUSH_CAPTION_AND_TAGS):
+                raise CIFFError("Invalid image: header not found", ERROR_TRUNCATED_HEADER)
+            if self._state == _PUSH_PIXELS:
+                raise CIFFError("Invalid image: pixel data not found", ERROR_TRUNCATED_PIXELS)
+        except CIFFError as e:
+            self._reject(e)
+            raise
+        if self._keep_pixels:
+            self._ciff.pixels = PixelBuffer(self._pixels, self._ciff.width, self._ciff.height)
+        self._state = _PUSH_CLOSED
+        return self._ciff
+
+    def _reject(self, error):
+        self._error = error
+        self._ciff.is_valid = False
+        self._ciff.error_code = error.code
+        # nothing fed after the rejection is needed
+        self._header = bytearray()
+        self._pixels = bytearray()
+
+    def _feed_fixed_header(self, data):
+        taken = data[:self._remaining]
+        self._header += taken
+        self._remaining -= len(taken)
+        # the magic can be checked before the size fields are complete
+        magic = bytes(self._header[:4])
+        if magic != b"CIFF"[:len(magic)]:
+            raise CIFFError("Invalid image: magic bytes do not match", ERROR_BAD_MAGIC)
+        if self._remaining == 0:
+            CIFF._parse_fixed_header(self._ciff, self._header)
+            if self._expected_size is not None:
+                # reject the upload before reading the rest of it
+                CIFF._check_file_size(self._ciff, self._expected_size)
+            self._header = bytearray()
+            self._state = _PUSH_CAPTION_AND_TAGS
+            self._remaining = self._ciff.header_size - _FIXED_HEADER.size
+        return data[len(taken):]
+
+    def _feed_caption_and_tags(self, data):
+        taken = data[:self._remaining].tobytes()
+        tag_start = 0
+        if self._caption_end is None:
+            newline = taken.find(b"\n")
+            caption = taken if newline == -1 else taken[:newline]
+            if not caption.isascii():
+                raise CIFFError("Invalid image: non-ASCII characters found in caption", ERROR_NON_ASCII)
+            if newline != -1:
+                self._caption_end = len(self._header) + newline
+                tag_start = newline + 1
+            else:
+                tag_start = len(taken)
+        tag_data = taken[tag_start:]
+        if not tag_data.isascii():
+            raise CIFFError("Invalid image: non-ASCII characters found in tags", ERROR_NON_ASCII)
+        if b"\n" in tag_data:
+            raise CIFFError("Invalid image: tags must not contain newline characters", ERROR_NEWLINE_IN_TAGS)
+        self._header += taken
+        self._remaining -= len(taken)
+        if self._remaining == 0:
+            # the whole header is in, extract the fields the usual way
+            CIFF._parse_caption_and_tags(self._ciff, bytes(self._header))
+            self._header = bytearray()
+            self._state = _PUSH_PIXELS
+            self._remaining = self._ciff.content_size
+            if self._remaining == 0:
+                self._state = _PUSH_END
+        return data[len(taken):]
+
+    def _feed_pixels(self, data):
+        taken = data[:self._remaining]
+        if self._keep_pixels:
+            self._pixels += taken
+        self._remaining -= len(taken)
+        if self._remaining == 0:
+            self._state = _PUSH_END
+        return data[len(taken):]
@@ -0,0 +1,100 @@
+import asyncio
+
+import ciff_backends
+from ciff import CIFF
+from ciff_batch import ValidationResult, validate_file
+
+# number of files validate_many works on at the same time by default
+DEFAULT_LIMIT = 8
+
+
+async def _run_blocking(executor, semaphore, function, *args):
+    """
+    Runs a blocking call in the executor without blocking the event loop
+
+    :param executor: concurrent.futures executor, None for the default one
+    :param semaphore: asyncio.Semaphore bounding the concurrent calls, or None
+    :return: the return value of the call
+    """
+    loop = asyncio.get_running_loop()
+    if semaphore is None:
+        return await loop.run_in_executor(executor, function, *args)
+    async with semaphore:
+        return await loop.run_in_executor(executor, function, *args)
+
+
+async def parse_ciff_file_async(file_path, backend="python", executor=None, semaphore=None):
+    """
+    Parses a CIFF file in an executor
+
+    With the default backend the pixels are read in the executor and the
+    parsed image holds them, so a thread pool executor should be used (the
+    default one of the event loop is). The mmap backend ("auto" picks it
+    for large files) and images over the memory budget (see ciff_budget)
+    are only mapped: their pixels are read from the disk when they are
+    first accessed, which then has to be done in an executor too. Pass a
+    semaphore shared by the callers to bound the number of images decoded
+    at the same time.
+
+    :param file_path: path the to file to be parsed (string)
+    :param backend: name of the backend, see ciff_backends.parse
+    :param executor: concurrent.futures executor, None for the default one
+    :param semaphore: asyncio.Semaphore bounding the concurrent parses, or None
+    :return: the parsed CIFF object
+    """
+    return await _run_blocking(executor, semaphore, ciff_backends.parse, file_path, backend)
+
+
+async def probe_async(file_path, executor=None, semaphore=None):
+    """
+    Parses only the header of a CIFF file in an executor, see CIFF.probe
+
+    :param file_path: path the to file to be probed (string)
+    :param executor: concurrent.futures executor, None for the default one
+    :param semaphore: asyncio.Semaphore bounding the concurrent probes, or None
+    :return: the CIFF object holding the metadata of the image
+    """
+    return await _run_blocking(executor, semaphore, CIFF.probe, file_path)
+
+
+async def validate_many(file_paths, limit=DEFAULT_LIMIT, executor=None, semaphore=None):
+    """
+    Validates files in an executor, at most `limit` of them at the same time
+
+    The results are yielded as the files are done, not in their original
+    order. At most `limit` files are in flight, so the memory use does not
+    grow with the number of files. Only the verdict and the metadata are
+    sent back, so a process pool executor works too.
+
+        async for result in validate_many(paths, limit=4):
+            print(result.path, result.is_valid)
+
+    :param file_paths: iterable of paths to validate
+    :param limit: the maximal number of files validated at the same time
+    :param executor: concurrent.futures executor, None for the default one
+    :param semaphore: asyncio.Semaphore shared with other callers, or None
+    :return: async generator of ciff_batch.ValidationResult tuples
+    """
+    file_paths = iter(file_paths)
+    in_flight = {}
+    try:
+        while True:
+            for file_path in file_paths:
+                task = asyncio.ensure_future(_run_blocking(executor, semaphore, validate_file, file_path))
+                in_flight[task] = file_path
+                if len(in_flight) >= limit:
+                    break
+            if not in_flight:
+                return
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                file_path = in_flight.pop(task)
+                try:
+                    is_valid, metadata = task.result()
+                except Exception as e:
+                    yield ValidationResult(file_path, None, str(e))
+                else:
+                    yield ValidationResult(file_path, is_valid, None, metadata)
+    finally:
+        for task in in_flight:
+            task.cancel()
@@ -0,0 +1,246 @@
+import importlib.util
+import json
+import os
+import warnings
+from collections import namedtuple
+
+from ciff import CIFF, PixelBuffer, ERROR_OVER_BUDGET, ERROR_UNKNOWN
+from ciff_budget import OVER_BUDGET_MMAP, OVER_BUDGET_REJECT, process_budget
+
+# environment variable that forces a backend for parse(..., backend="auto")
+BACKEND_VARIABLE = "CIFF_BACKEND"
+# environment variable holding the path of a calibration file
+CALIBRATION_VARIABLE = "CIFF_CALIBRATION"
+
+# the teaching copy of the parser from the second lab
+LAB2_PARSER_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "Lab 2", "ciff-viewer", "src", "ciff.py"
+)
+
+# which backend is the fastest up to a given file size (None: no limit),
+# used when no calibration file is given; the entries are tried in order
+DEFAULT_CALIBRATION = [
+    {"max_size": 256 * 1024, "backend": "python"},
+    {"max_size": None, "backend": "mmap"},
+]
+
+# backend used when the preferred one is not available
+FALLBACK_BACKEND = "python"
+
+# heap memory the backends need per byte of the file: the pixels once, the
+# native parser holds them twice while copying them out, the lab2 parser
+# keeps a tuple per pixel; a memory mapping needs none
+PYTHON_MEMORY_FACTOR = 1
+NATIVE_MEMORY_FACTOR = 2
+LAB2_MEMORY_FACTOR = 25
+
+# a parser implementation: parse takes a file path and returns a CIFF
+# object, is_available tells whether it can be used in this process,
+# memory_factor is the heap memory needed per byte of the file
+Backend = namedtuple("Backend", ["name", "parse", "is_available", "memory_factor"])
+
+_backends = {}
+_availability = {}
+_lab2 = {}
+
+
+def register_backend(name, parse_function, is_available=None, memory_factor=PYTHON_MEMORY_FACTOR):
+    """
+    Registers a parser implementation
+
+    :param name: name to select the backend with
+    :param parse_function: callable taking a file path, returning a CIFF object
+    :param is_available: callable telling whether the backend can be used,
+                         it is only called once (None: always available)
+    :param memory_factor: heap memory the backend needs per byte of the file,
+                          0 if it does not load the file into memory
+    """
+    _backends[name] = Backend(name, parse_function, is_available or (lambda: True), memory_factor)
+    _availability.pop(name, None)
+
+
+def backend_names():
+    """
+    The names of the registered backends
+
+    :return: list of strings
+    """
+    return list(_backends)
+
+
+def is_backend_available(name):
+    """
+    Tells whether a backend is registered and can be used
+
+    :param name: name of the backend
+    :return: boolean
+    """
+    if name not in _backends:
+        return False
+    if name not in _availability:
+        try:
+            _availability[name] = bool(_backends[name].is_available())
+        except Exception:
+            _availability[name] = False
+    return _availability[name]
+
+
+def available_backends():
+    """
+    The names of the backends that can be used
+
+    :return: list of strings
+    """
+    return [name for name in _backends if is_backend_available(name)]
+
+
+def load_calibration(calibration_path=None):
+    """
+    Loads the size thresholds the automatic backend selection is based on
+
+    The calibration file is a JSON object with a "thresholds" list of
+    {"max_size": bytes or null, "backend": name} entries, as written by
+    the benchmark suite.
+
+    :param calibration_path: path of the calibration file (defaults to
+                             the CIFF_CALIBRATION environment variable)
+    :return: list of threshold entries
+    """
+    calibration_path = calibration_path or os.environ.get(CALIBRATION_VARIABLE)
+    if not calibration_path:
+        return DEFAULT_CALIBRATION
+    with open(calibration_path) as calibration_file:
+        return json.load(calibration_file)["thresholds"]
+
+
+def select_backend(file_size, calibration=None):
+    """
+    Picks the backend to parse a file of the given size with
+
+    :param file_size: size of the file in bytes
+    :param calibration: threshold entries (defaults to load_calibration())
+    :return: name of the backend
+    :raises ValueError: if CIFF_BACKEND names no registered backend
+    """
+    forced = os.environ.get(BACKEND_VARIABLE)
+    if forced and forced != "auto":
+        if forced not in _backends:
+            raise ValueError(f"Unknown CIFF parser backend in {BACKEND_VARIABLE}: {forced}")
+        if not is_backend_available(forced):
+            warnings.warn(
+                f"CIFF parser backend {forced} set in {BACKEND_VARIABLE} is not available, "
+                f"using {FALLBACK_BACKEND}",
+                RuntimeWarning
+            )
+            return FALLBACK_BACKEND
+        return forced
+    if calibration is None:
+        calibration = load_calibration()
+    for threshold in calibration:
+        if threshold["max_size"] is None or file_size <= threshold["max_size"]:
+            if is_backend_available(threshold["backend"]):
+                return threshold["backend"]
+    return FALLBACK_BACKEND
+
+
+def parse(file_path, backend="auto", budget=None, over_budget=OVER_BUDGET_MMAP, timeout=None):
+    """
+    Parses a CIFF file with the given or the automatically selected backend
+
+    The memory the backend needs is reserved from a budget first, see
+    ciff_budget. As the parsers never read more than the size of the file,
+    a forged size field cannot make them exceed their reservation. A parse
+    that does not fit waits for the concurrent ones to release memory; an
+    image exceeding the per parse limit (or still not fitting after the
+    timeout) is parsed through a memory mapping instead, or rejected with
+    ERROR_OVER_BUDGET.
+
+    :param file_path: path the to file to be parsed (string)
+    :param backend: name of the backend, or "auto" to pick the fastest
+                    available one for the size of the file
+    :param budget: ciff_budget.MemoryBudget, None for the one of the process
+    :param over_budget: OVER_BUDGET_MMAP or OVER_BUDGET_REJECT
+    :param timeout: seconds to wait for the memory at most (None: no limit)
+    :return: the parsed CIFF object
+    :raises ValueError: if the requested backend is not available, or
+                        CIFF_BACKEND names no registered backend
+    """
+    if over_budget not in (OVER_BUDGET_MMAP, OVER_BUDGET_REJECT):
+        raise ValueError(f"Unknown over budget policy: {over_budget}")
+    try:
+        file_size = os.path.getsize(file_path)
+    except OSError:
+        # let the parser report the file as invalid
+        file_size = 0
+    if backend == "auto":
+        backend = select_backend(file_size)
+    elif not is_backend_available(backend):
+        raise ValueError(f"CIFF parser backend not available: {backend}")
+
+    cost = file_size * _backends[backend].memory_factor
+    if cost == 0:
+        return _backends[backend].parse(file_path)
+    if budget is None:
+        budget = process_budget()
+    if budget.reserve(cost, timeout):
+        try:
+            return _backends[backend].parse(file_path)
+        finally:
+            budget.release(cost)
+    if over_budget == OVER_BUDGET_MMAP:
+        # the pixels are paged in from the file on demand, not copied
+        return _backends["mmap"].parse(file_path)
+    rejected = CIFF.precheck(file_path)
+    if rejected.is_valid:
+        rejected.is_valid = False
+        rejected.error_code = ERROR_OVER_BUDGET
+    return rejected
+
+
+def _native_parse(file_path):
+    from ciff_native import load_native_ciff_image
+    return load_native_ciff_image(file_path)
+
+
+def _native_available():
+    from ciff_native import load_library
+    # the size of the images is limited by the budget passed to parse(),
+    # not by the global limit of the native library
+    load_library()
+    return True
+
+
+def _lab2_parse(file_path):
+    lab2_ciff = _load_lab2_module().CIFF.parse_ciff_file(file_path)
+    # every backend returns a ciff.CIFF with the pixels in a PixelBuffer
+    new_ciff = CIFF()
+    if not lab2_ciff.is_valid:
+        # the lab2 parser only logs the reason of the rejection
+        new_ciff.is_valid = False
+        new_ciff.error_code = ERROR_UNKNOWN
+        return new_ciff
+    new_ciff.magic = lab2_ciff.magic
+    new_ciff.header_size = lab2_ciff.header_size
+    new_ciff.content_size = lab2_ciff.content_size
+    new_ciff.width = lab2_ciff.width
+    new_ciff.height = lab2_ciff.height
+    new_ciff.caption = lab2_ciff.caption
+    new_ciff.tags = lab2_ciff.tags
+    new_ciff.pixels = PixelBuffer.from_pixels(lab2_ciff.pixels, lab2_ciff.width, lab2_ciff.height)
+    return new_ciff
+
+
+def _load_lab2_module():
+    # the directory name contains a space, so it is loaded by its path
+    if "module" not in _lab2:
+        spec = importlib.util.spec_from_file_location("lab2_ciff", LAB2_PARSER_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _lab2["module"] = module
+    return _lab2["module"]
+
+
+register_backend("python", CIFF.parse_ciff_file)
+register_backend("mmap", lambda file_path: CIFF.parse_ciff_file(file_path, mode="mmap"), memory_factor=0)
+register_backend("native", _native_parse, _native_available, NATIVE_MEMORY_FACTOR)
+register_backend("lab2", _lab2_parse, lambda: os.path.isfile(LAB2_PARSER_PATH), LAB2_MEMORY_FACTOR)
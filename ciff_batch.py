@@ -0,0 +1,368 @@
+import os
+import re
+import signal
+import time
+from collections import deque, namedtuple
+from multiprocessing import Pool, TimeoutError
+from os import listdir
+
+import ciff_backends
+from ciff import set_profile_hook
+from ciff_cache import file_identity, metadata_of
+
+# seconds a single file may take before its worker is considered stuck
+DEFAULT_TIMEOUT = 60
+
+# seconds between two scans of a watched directory by default
+DEFAULT_POLL_INTERVAL = 2.0
+
+# kinds of changes reported when watching a directory
+CHANGE_ADDED = "added"
+CHANGE_MODIFIED = "modified"
+CHANGE_REMOVED = "removed"
+
+# outcome of validating a single file: is_valid is None if the parsing
+# failed in an unexpected way, in which case error holds the reason;
+# metadata is a dict of the header fields (see ciff_cache.metadata_of);
+# profile is the ciff.ParseProfile of the parse if it was profiled
+ValidationResult = namedtuple(
+    "ValidationResult", ["path", "is_valid", "error", "metadata", "profile"], defaults=[None, None]
+)
+
+# a change found in a watched directory: result is the ValidationResult of
+# the added or modified file, for a removed file only its path is set
+VerdictChange = namedtuple("VerdictChange", ["kind", "result"])
+
+
+def natural_key(name):
+    """
+    Sort key ordering the numbers in names by their value
+
+    test2.ciff comes before test10.ciff, names without numbers are sorted
+    alphabetically.
+
+    :param name: file name or path
+    :return: list of the text and number parts
+    """
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name)]
+
+
+def sorted_test_vectors(directory):
+    """
+    Lists the files of a directory in their natural order, see natural_key
+
+    :param directory: directory holding the testN.ciff files
+    :return: list of the file names
+    """
+    return sorted(listdir(directory), key=natural_key)
+
+
+def ignore_interrupts():
+    """
+    Lets the parent handle Ctrl-C, this runs in the worker processes
+
+    A WorkerPool outlives the batches, an interrupt would otherwise also
+    reach its idle workers and print a traceback for each one.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def validate_file(file_path):
+    """
+    Parses a single file, this runs in the worker processes
+
+    The Python parser is used within the memory budget of the worker
+    (see ciff_budget), larger images are parsed through a memory mapping.
+
+    :param file_path: path to the file to validate
+    :return: the is_valid flag and the header metadata of the parsed image
+    """
+    parsed = ciff_backends.parse(file_path, "python")
+    return parsed.is_valid, metadata_of(parsed)
+
+
+def profile_file(file_path):
+    """
+    Parses a single file with profiling on, this runs in the worker processes
+
+    :param file_path: path to the file to validate
+    :return: the is_valid flag, the header metadata and the ciff.ParseProfile
+             (its mode is "mmap" if the image was over the memory budget)
+    """
+    profiles = []
+    previous = set_profile_hook(profiles.append)
+    try:
+        is_valid, metadata = validate_file(file_path)
+    finally:
+        set_profile_hook(previous)
+    return is_valid, metadata, profiles[0] if profiles else None
+
+
+def check_file(file_path, hash_content=False, known_hash=None, profile=False):
+    """
+    Identifies and parses a single file for a cache, this runs in the worker processes
+
+    The identity is taken before parsing, so a verdict is never cached
+    under the identity of a newer version of the file than the parsed one.
+    If the contents hash to known_hash, the cached verdict still holds and
+    the file is not parsed.
+
+    :param file_path: path to the file to validate
+    :param hash_content: also hash the contents, see ciff_cache.file_identity
+    :param known_hash: the hash the file was cached with, or None
+    :param profile: profile the parsing, see profile_file
+    :return: the ciff_cache.FileIdentity, and the result of validate_file
+             or profile_file, None if the file was not parsed
+    """
+    identity = file_identity(file_path, hash_content)
+    if known_hash is not None and identity is not None and identity.content_hash == known_hash:
+        return identity, None
+    return identity, (profile_file if profile else validate_file)(file_path)
+
+
+class WorkerPool:
+    """
+    A pool of worker processes, started on first use and replaceable
+
+    validate_files replaces the pool when a worker hangs. Passing the same
+    WorkerPool to several calls keeps its processes alive between them
+    instead of starting and terminating a pool per call.
+    """
+
+    def __init__(self, jobs=None):
+        """
+        Constructor for worker pools
+
+        :param jobs: number of worker processes (defaults to the CPU count)
+        """
+        self.jobs = jobs or os.cpu_count() or 1
+        self._pool = None
+
+    def get(self):
+        """
+        :return: the multiprocessing pool, started if it is not running
+        """
+        if self._pool is None:
+            self._pool = Pool(self.jobs, initializer=ignore_interrupts)
+        return self._pool
+
+    def replace(self):
+        """
+        Terminates the workers, with whatever they are running, and starts new ones
+
+        :return: the new multiprocessing pool
+        """
+        self.close()
+        return self.get()
+
+    def close(self):
+        """
+        Terminates the workers, the next get() starts new ones
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def validate_files(file_paths, jobs=None, timeout=DEFAULT_TIMEOUT, cache=None, profile=False, workers=None):
+    """
+    Validates files in parallel on a pool of worker processes
+
+    The results are yielded in the order of file_paths as soon as they
+    are available. Only a few files per worker are queued ahead, so the
+    oldest pending file is always the one being waited for. If it does
+    not finish within the timeout (its worker hangs or has crashed), the
+    pool is replaced and the rest of the files are resubmitted, so a
+    single bad file cannot stall or kill the whole run.
+
+    Files with a current verdict in the cache are not parsed again, the
+    verdicts of the parsed files are stored in it under the identity the
+    files had before they were parsed. In content hash mode the workers
+    hash the files whose identity changed.
+
+    With profiling on, the workers time the phases of every parse and the
+    results of the parsed (not the cached) files carry their profiles.
+
+    :param file_paths: iterable of paths to validate
+    :param jobs: number of worker processes (defaults to the CPU count)
+    :param timeout: seconds to wait for the result of a single file
+    :param cache: a ciff_cache.ValidationCache, or None
+    :param profile: profile the parsing, see ciff.set_profile_hook
+    :param workers: a WorkerPool to run on and leave running (jobs is then
+                    ignored), or None for a pool of this call only
+    :return: generator of ValidationResult tuples
+    """
+    file_paths = list(file_paths)
+    own_workers = workers is None
+    if own_workers:
+        workers = WorkerPool(jobs)
+    jobs = workers.jobs
+    hash_content = cache is not None and cache.hash_content
+
+    def submit(file_path, known_hash=None):
+        return workers.get().apply_async(check_file, (file_path, hash_content, known_hash, profile))
+
+    try:
+        # each entry is a file path with either its cached result or the
+        # handle of the pending parsing
+        pending = deque()
+        position = 0
+        while pending or position < len(file_paths):
+            # keep every worker busy without queueing up the whole batch
+            while position < len(file_paths) and len(pending) < jobs * 2:
+                file_path = file_paths[position]
+                position += 1
+                cached = cache.lookup(file_path) if cache is not None else None
+                if cached is not None:
+                    pending.append((
+                        file_path,
+                        ValidationResult(file_path, cached.is_valid, None, cached.metadata)
+                    ))
+                    continue
+                known_hash = cache.stored_hash(file_path) if cache is not None else None
+                pending.append((file_path, submit(file_path, known_hash)))
+
+            file_path, result = pending.popleft()
+            if isinstance(result, ValidationResult):
+                yield result
+                continue
+            try:
+                identity, parsed = result.get(timeout)
+            except TimeoutError:
+                # the worker is stuck or gone, start over with a fresh pool
+                workers.replace()
+                pending = deque(
+                    (path, other) if isinstance(other, ValidationResult)
+                    else (path, submit(path, cache.stored_hash(path) if cache is not None else None))
+                    for path, other in pending
+                )
+                yield ValidationResult(file_path, None, f"timed out after {timeout} seconds")
+            except Exception as e:
+                yield ValidationResult(file_path, None, str(e))
+            else:
+                if parsed is None:
+                    # the contents hash like the cached ones
+                    cached = cache.lookup(file_path, identity)
+                    if cached is None:
+                        # the entry changed meanwhile, parse the file after all
+                        pending.appendleft((file_path, submit(file_path)))
+                        continue
+                    yield ValidationResult(file_path, cached.is_valid, None, cached.metadata)
+                    continue
+                is_valid, metadata, *profiled = parsed
+                if cache is not None:
+                    cache.store(file_path, is_valid, metadata, identity)
+                yield ValidationResult(file_path, is_valid, None, metadata, *profiled)
+        if cache is not None:
+            cache.commit()
+    finally:
+        if own_workers:
+            workers.close()
+
+
+def snapshot(directory):
+    """
+    Records the identity of the files of a directory
+
+    :param directory: directory to scan (not recursively)
+    :return: dict of the paths and their (size, mtime_ns) pairs
+    """
+    files = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file():
+                    stat = entry.stat()
+                    files[entry.path] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                # removed while scanning
+                continue
+    return files
+
+
+class DirectoryWatcher:
+    """
+    Validates the files of a directory incrementally
+
+    A snapshot of the size and modification time of the files is kept
+    between polls. Each poll only parses the files that were added or
+    modified since the previous one and reports the removed ones, so the
+    work done per poll does not grow with the number of unchanged files.
+    The first poll reports every file as added. The worker processes are
+    kept between polls until the watcher is closed.
+    """
+
+    def __init__(self, directory, jobs=None, timeout=DEFAULT_TIMEOUT, cache=None):
+        """
+        Constructor for directory watchers
+
+        :param directory: directory to watch (not recursively)
+        :param jobs: number of worker processes (defaults to the CPU count)
+        :param timeout: seconds to wait for the result of a single file
+        :param cache: a ciff_cache.ValidationCache, or None
+        """
+        self._directory = directory
+        self._workers = WorkerPool(jobs)
+        self._timeout = timeout
+        self._cache = cache
+        self._snapshot = {}
+
+    def poll(self):
+        """
+        Scans the directory and validates the changed files
+
+        A file is only recorded as seen once its change was yielded, so the
+        changes not consumed are reported again by the next poll.
+
+        :return: generator of VerdictChange tuples, the removed files first
+        """
+        current = snapshot(self._directory)
+        for file_path in sorted(set(self._snapshot) - set(current), key=natural_key):
+            del self._snapshot[file_path]
+            yield VerdictChange(CHANGE_REMOVED, ValidationResult(file_path, None, None))
+
+        changed = sorted(
+            (file_path for file_path, identity in current.items() if self._snapshot.get(file_path) != identity),
+            key=natural_key
+        )
+        for result in validate_files(changed, timeout=self._timeout, cache=self._cache, workers=self._workers):
+            kind = CHANGE_MODIFIED if result.path in self._snapshot else CHANGE_ADDED
+            self._snapshot[result.path] = current[result.path]
+            yield VerdictChange(kind, result)
+
+    def close(self):
+        """
+        Terminates the worker processes
+        """
+        self._workers.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def watch_directory(directory, interval=DEFAULT_POLL_INTERVAL, jobs=None, timeout=DEFAULT_TIMEOUT, cache=None):
+    """
+    Validates the files of a directory and then the changes, forever
+
+    See DirectoryWatcher, the directory is polled every `interval` seconds.
+
+    :param directory: directory to watch (not recursively)
+    :param interval: seconds to wait between two polls
+    :param jobs: number of worker processes (defaults to the CPU count)
+    :param timeout: seconds to wait for the result of a single file
+    :param cache: a ciff_cache.ValidationCache, or None
+    :return: generator of VerdictChange tuples
+    """
+    with DirectoryWatcher(directory, jobs, timeout, cache) as watcher:
+        while True:
+            yield from watcher.poll()
+            time.sleep(interval)
@@ -0,0 +1,133 @@
+import os
+import threading
+
+# environment variables setting the budget of the process, in bytes
+BUDGET_VARIABLE = "CIFF_MEMORY_BUDGET"
+PARSE_LIMIT_VARIABLE = "CIFF_PARSE_MEMORY_LIMIT"
+
+# memory the concurrent parses of a process may use together by default
+DEFAULT_BUDGET = 2 * 1024 * 1024 * 1024
+
+# memory a single parse may use by default
+DEFAULT_PARSE_LIMIT = 512 * 1024 * 1024
+
+# what happens to an image that does not fit into the budget: it is either
+# parsed through a memory mapping, which keeps the pixels out of the heap,
+# or rejected without parsing it
+OVER_BUDGET_MMAP = "mmap"
+OVER_BUDGET_REJECT = "reject"
+
+_process_budget = None
+_process_budget_lock = threading.Lock()
+
+
+class MemoryBudget:
+    """
+    Memory shared by the concurrent parses of a process
+
+    A parse reserves the memory its image needs before reading it and
+    releases it when done. A reservation that does not fit into the free
+    part of the budget waits until enough memory is released, so under
+    load the parses queue up instead of pushing the process into swapping.
+    A single reservation is limited to parse_limit bytes.
+    """
+
+    def __init__(self, capacity=DEFAULT_BUDGET, parse_limit=DEFAULT_PARSE_LIMIT):
+        """
+        Constructor for memory budgets
+
+        :param capacity: memory all the parses may use together, in bytes
+        :param parse_limit: memory a single parse may use, in bytes
+        """
+        self._capacity = capacity
+        self._parse_limit = min(parse_limit, capacity)
+        self._in_use = 0
+        self._condition = threading.Condition()
+
+    @property
+    def capacity(self):
+        """
+        Memory all the parses may use together
+
+        :return: int, bytes
+        """
+        return self._capacity
+
+    @property
+    def parse_limit(self):
+        """
+        Memory a single parse may use
+
+        :return: int, bytes
+        """
+        return self._parse_limit
+
+    @property
+    def in_use(self):
+        """
+        Memory reserved by the running parses
+
+        :return: int, bytes
+        """
+        return self._in_use
+
+    def reserve(self, size, timeout=None):
+        """
+        Reserves memory for a parse, waiting for it if needed
+
+        :param size: the memory needed, in bytes
+        :param timeout: seconds to wait at most (None: no limit)
+        :return: True if the memory was reserved, False if size exceeds the
+                 parse limit or the wait timed out
+        """
+        if size > self._parse_limit:
+            return False
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._in_use + size <= self._capacity, timeout):
+                return False
+            self._in_use += size
+            return True
+
+    def release(self, size):
+        """
+        Releases memory reserved by reserve()
+
+        :param size: the memory reserved, in bytes
+        """
+        with self._condition:
+            self._in_use -= size
+            self._condition.notify_all()
+
+
+def process_budget():
+    """
+    The budget shared by the parses of this process
+
+    It is created on first use from the CIFF_MEMORY_BUDGET and the
+    CIFF_PARSE_MEMORY_LIMIT environment variables, or the defaults.
+
+    :return: MemoryBudget
+    """
+    global _process_budget
+    with _process_budget_lock:
+        if _process_budget is None:
+            _process_budget = MemoryBudget(
+                int(os.environ.get(BUDGET_VARIABLE) or DEFAULT_BUDGET),
+                int(os.environ.get(PARSE_LIMIT_VARIABLE) or DEFAULT_PARSE_LIMIT)
+            )
+        return _process_budget
+
+
+def set_process_budget(budget):
+    """
+    Replaces the budget shared by the parses of this process
+
+    :param budget: the new MemoryBudget, None to recreate it from the
+                   environment on next use
+    :return: the previous budget
+    """
+    global _process_budget
+    with _process_budget_lock:
+        previous = _process_budget
+        _process_budget = budget
+        return previous
@@ -0,0 +1,224 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import namedtuple
+
+# cache file used by the viewer
+DEFAULT_CACHE_PATH = ".ciff_cache.sqlite"
+
+# number of verdicts kept before the least recently used ones are evicted
+DEFAULT_MAX_ENTRIES = 1000000
+
+# a cached verdict: metadata is a dict of the header fields (see metadata_of)
+CachedVerdict = namedtuple("CachedVerdict", ["is_valid", "metadata"])
+
+# what a verdict is cached under: content_hash is None unless the contents
+# were hashed
+FileIdentity = namedtuple("FileIdentity", ["size", "mtime_ns", "inode", "content_hash"])
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS verdicts (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    content_hash TEXT,
+    is_valid INTEGER NOT NULL,
+    metadata TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS verdicts_last_used ON verdicts (last_used);
+"""
+
+
+def metadata_of(ciff):
+    """
+    Collects the header fields and the error code of a parsed image
+
+    :param ciff: the parsed CIFF object
+    :return: dict that can be stored as JSON
+    """
+    return {
+        "magic": ciff.magic,
+        "header_size": ciff.header_size,
+        "content_size": ciff.content_size,
+        "width": ciff.width,
+        "height": ciff.height,
+        "caption": ciff.caption,
+        "tags": list(ciff.tags),
+        "error_code": ciff.error_code,
+    }
+
+
+def hash_file(file_path):
+    """
+    SHA-256 digest of the contents of a file
+
+    :param file_path: path of the file
+    :return: the hex digest
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as hashed_file:
+        for chunk in iter(lambda: hashed_file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_identity(file_path, hash_content=False):
+    """
+    Records the identity of a file
+
+    It has to be taken before the file is parsed: if the file changes
+    while being parsed, the verdict is then stored under the old identity
+    and the file is parsed again instead of reusing a stale verdict.
+
+    :param file_path: path of the file
+    :param hash_content: also hash the contents (see hash_file)
+    :return: FileIdentity, or None if the file cannot be accessed
+    """
+    try:
+        stat = os.stat(file_path)
+        content_hash = hash_file(file_path) if hash_content else None
+    except OSError:
+        return None
+    return FileIdentity(stat.st_size, stat.st_mtime_ns, stat.st_ino, content_hash)
+
+
+class ValidationCache:
+    """
+    On-disk cache of validation verdicts and header metadata
+
+    An entry is reused as long as the size, the modification time and the
+    inode of the file are unchanged. In content hash mode an entry whose
+    identity changed is still reused if the SHA-256 of the file matches,
+    e.g. after the file was copied or touched. The cache never reads the
+    files itself: the hashes are taken by the caller, see file_identity,
+    which can be done on the worker processes. The cache holds at most
+    max_entries verdicts, the least recently used ones are evicted when
+    the changes are committed.
+    """
+
+    def __init__(self, db_path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES, hash_content=False):
+        """
+        Constructor for validation caches
+
+        :param db_path: path of the SQLite database, created if missing
+        :param max_entries: the maximal number of cached verdicts
+        :param hash_content: also match entries by the hash of the contents
+        """
+        self._connection = sqlite3.connect(db_path)
+        self._connection.executescript(_SCHEMA)
+        self._max_entries = max_entries
+        self._hash_content = hash_content
+
+    @property
+    def hash_content(self):
+        """
+        Whether the entries are also matched by the hash of the contents
+
+        :return: bool
+        """
+        return self._hash_content
+
+    def lookup(self, file_path, identity=None):
+        """
+        Looks up the verdict of a file
+
+        :param file_path: path of the file
+        :param identity: the FileIdentity of the file, taken now (without
+                         hashing) if None; an entry whose identity changed
+                         is only reused if this carries a matching hash
+        :return: CachedVerdict, or None if the file is not cached or changed
+        """
+        if identity is None:
+            identity = file_identity(file_path)
+            if identity is None:
+                return None
+        row = self._connection.execute(
+            "SELECT size, mtime_ns, inode, content_hash, is_valid, metadata FROM verdicts WHERE path = ?",
+            (os.path.abspath(file_path),)
+        ).fetchone()
+        if row is None:
+            return None
+        size, mtime_ns, inode, content_hash, is_valid, metadata = row
+        if size != identity.size:
+            return None
+        if (mtime_ns, inode) != (identity.mtime_ns, identity.inode):
+            if not self._hash_content or identity.content_hash is None or content_hash != identity.content_hash:
+                return None
+        # the entry is current, refresh its identity and its age
+        self._connection.execute(
+            "UPDATE verdicts SET mtime_ns = ?, inode = ?, last_used = ? WHERE path = ?",
+            (identity.mtime_ns, identity.inode, time.time(), os.path.abspath(file_path))
+        )
+        return CachedVerdict(bool(is_valid), json.loads(metadata))
+
+    def stored_hash(self, file_path):
+        """
+        The content hash a file was cached with
+
+        :param file_path: path of the file
+        :return: the hex digest, or None if the file is not cached, or not
+                 in content hash mode
+        """
+        if not self._hash_content:
+            return None
+        row = self._connection.execute(
+            "SELECT content_hash FROM verdicts WHERE path = ?", (os.path.abspath(file_path),)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def store(self, file_path, is_valid, metadata, identity):
+        """
+        Stores the verdict of a file
+
+        :param file_path: path of the file
+        :param is_valid: the verdict
+        :param metadata: dict of the header fields (see metadata_of)
+        :param identity: the FileIdentity taken before the file was parsed,
+                         with the hash of the contents in content hash mode;
+                         nothing is stored if None
+        """
+        if identity is None:
+            return
+        self._connection.execute(
+            "INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                os.path.abspath(file_path), identity.size, identity.mtime_ns, identity.inode,
+                identity.content_hash, int(bool(is_valid)), json.dumps(metadata), time.time()
+            )
+        )
+
+    def commit(self):
+        """
+        Evicts the excess entries and writes the pending changes to the disk
+        """
+        self._evict()
+        self._connection.commit()
+
+    def close(self):
+        """
+        Commits the pending changes and closes the database
+        """
+        self.commit()
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._connection.execute("SELECT COUNT(*) FROM verdicts").fetchone()[0]
+
+    def _evict(self):
+        excess = len(self) - self._max_entries
+        if excess > 0:
+            self._connection.execute(
+                "DELETE FROM verdicts WHERE path IN "
+                "(SELECT path FROM verdicts ORDER BY last_used LIMIT ?)",
+                (excess,)
+            )
@@ -0,0 +1,266 @@
+import json
+import os
+import threading
+import time
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Pool, TimeoutError
+
+import ciff_backends
+from ciff import CIFFError, CIFFPushParser
+from ciff_batch import DEFAULT_TIMEOUT
+from ciff_cache import metadata_of
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+# the largest raw image accepted in a request body
+DEFAULT_MAX_BODY = 256 * 1024 * 1024
+
+# bytes of a raw image body read at a time
+_UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# seconds between two checks whether the pool of a waiting request was
+# replaced under it
+_POOL_CHECK_INTERVAL = 0.1
+
+
+def warm_up():
+    """
+    Loads the parsers in a worker process before the first request arrives
+    """
+    # checking the availability loads the native library once per worker
+    ciff_backends.available_backends()
+
+
+def validate_path(file_path, backend):
+    """
+    Validates a single file, this runs in the worker processes
+
+    :param file_path: path of the file
+    :param backend: name of the backend, see ciff_backends.parse
+    :return: dict of the verdict and the metadata
+    """
+    parsed = ciff_backends.parse(file_path, backend)
+    return {"is_valid": parsed.is_valid, "metadata": metadata_of(parsed)}
+
+
+class ValidationService:
+    """
+    A pool of warm worker processes validating CIFF images
+
+    The pool is replaced if a validation times out (its worker hangs or
+    died). That kills the other validations running on the pool too, so
+    those are resubmitted to the new pool with a fresh timeout: a hanging
+    or crashing file only fails its own request.
+    """
+
+    def __init__(self, jobs=None, timeout=DEFAULT_TIMEOUT):
+        """
+        Constructor for validation services
+
+        :param jobs: number of worker processes (defaults to the CPU count)
+        :param timeout: seconds a single validation may take
+        """
+        self._jobs = jobs or os.cpu_count() or 1
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._pool = self._start_pool()
+
+    def _start_pool(self):
+        # the workers are started and warmed up right away
+        return Pool(self._jobs, initializer=warm_up)
+
+    def validate_path(self, file_path, backend="auto"):
+        """
+        Validates a file on one of the workers
+
+        :param file_path: path of the file
+        :param backend: name of the backend, see ciff_backends.parse
+        :return: dict of the verdict and the metadata
+        :raises TimeoutError: if the validation takes too long
+        """
+        while True:
+            with self._lock:
+                pool = self._pool
+            try:
+                result = pool.apply_async(validate_path, (file_path, backend))
+            except ValueError:
+                # the pool was terminated right after it was picked
+                continue
+            deadline = time.monotonic() + self._timeout
+            while not result.ready():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    # a worker is stuck, or died and its task was lost:
+                    # continue with a fresh pool
+                    self._replace_pool(pool)
+                    raise TimeoutError(f"timed out after {self._timeout} seconds")
+                if self._pool is not pool:
+                    # another request timed out and took this one down
+                    # with its pool, try again on the new one
+                    break
+                result.wait(min(remaining, _POOL_CHECK_INTERVAL))
+            else:
+                return result.get()
+
+    def _replace_pool(self, pool):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = self._start_pool()
+                pool.terminate()
+
+    def validate_upload(self, stream, length):
+        """
+        Validates an image while it is being received
+
+        The image is checked by a push parser chunk by chunk and the pixels
+        are not kept, so the memory use does not depend on the size of the
+        image. Reading stops at the first invalid byte, and at the size
+        fields already if they do not match the length of the body.
+
+        :param stream: binary stream the image is read from
+        :param length: the size of the image in bytes
+        :return: dict of the verdict and the metadata, and the number of
+                 bytes left unread in the stream
+        """
+        # the size fields are checked against the announced length, so a
+        # body that cannot match them is rejected after 36 bytes
+        parser = CIFFPushParser(keep_pixels=False, expected_size=length)
+        # read1 returns what has arrived instead of waiting for a full chunk
+        read = getattr(stream, "read1", stream.read)
+        try:
+            while length:
+                chunk = read(min(length, _UPLOAD_CHUNK_SIZE))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                parser.feed(chunk)
+            parser.close()
+        except CIFFError:
+            pass
+        parsed = parser.result
+        return {"is_valid": parsed.is_valid, "metadata": metadata_of(parsed)}, length
+
+    def close(self):
+        """
+        Stops the worker processes
+        """
+        self._pool.terminate()
+
+
+class ValidationRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the validation requests of a ValidationServer
+
+    POST /validate with a JSON body of {"path": ..., "backend": ...}
+    validates a file, with an application/octet-stream body it validates
+    the image in the body. GET /health tells whether the server is up.
+    """
+
+    def do_GET(self):
+        if self.path != "/health":
+            self._reply(404, {"error": "not found"})
+            return
+        self._reply(200, {"status": "ok", "backends": ciff_backends.available_backends()})
+
+    def do_POST(self):
+        if self.path.split("?", 1)[0] != "/validate":
+            self._reply(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers["Content-Length"])
+            if length < 0:
+                raise ValueError
+        except (KeyError, TypeError, ValueError):
+            # the body cannot be delimited, so the connection cannot be reused
+            self.close_connection = True
+            self._reply(400, {"error": "bad request: missing or invalid Content-Length"})
+            return
+        if length > self.server.max_body:
+            self.close_connection = True
+            self._reply(413, {"error": "request body too large"})
+            return
+        service = self.server.service
+        try:
+            if self.headers.get("Content-Type", "").startswith("application/octet-stream"):
+                result, unread = service.validate_upload(self.rfile, length)
+                if unread:
+                    # the rest of a rejected upload is not read, so the
+                    # connection cannot be reused
+                    self.close_connection = True
+            else:
+                request = json.loads(self.rfile.read(length))
+                result = service.validate_path(request["path"], request.get("backend", "auto"))
+                result["path"] = request["path"]
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {"error": f"bad request: {e}"})
+        except TimeoutError:
+            self._reply(504, {"error": "validation timed out"})
+        except Exception as e:
+            self._reply(500, {"error": str(e)})
+        else:
+            self._reply(200, result)
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class ValidationServer(ThreadingHTTPServer):
+    """
+    HTTP server answering validation requests from a ValidationService
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, service, max_body=DEFAULT_MAX_BODY, verbose=False):
+        """
+        Constructor for validation servers
+
+        :param address: (host, port) to listen on
+        :param service: the ValidationService doing the work
+        :param max_body: the largest accepted request body in bytes
+        :param verbose: log every request
+        """
+        super().__init__(address, ValidationRequestHandler)
+        self.service = service
+        self.max_body = max_body
+        self.verbose = verbose
+
+
+def main():
+    parser = ArgumentParser(description="Serve CIFF validation requests on localhost")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="address to listen on")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port to listen on")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                        help="number of worker processes (default: CPU count)")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT,
+                        help="seconds a single validation may take")
+    parser.add_argument("--max-body", type=int, default=DEFAULT_MAX_BODY,
+                        help="the largest accepted image in bytes")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    args = parser.parse_args()
+
+    service = ValidationService(args.jobs, args.timeout)
+    server = ValidationServer((args.host, args.port), service, args.max_body, args.verbose)
+    print(f"Serving CIFF validation on http://{args.host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
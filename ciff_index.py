@@ -0,0 +1,258 @@
+import os
+import re
+import sqlite3
+from argparse import ArgumentParser
+from collections import namedtuple
+
+from ciff import CIFF
+
+# index file used when none is given
+DEFAULT_INDEX_PATH = ".ciff_index.sqlite"
+
+# extension of the files picked up when walking a directory tree
+CIFF_EXTENSION = ".ciff"
+
+# kinds of the indexed terms
+TERM_TAG = "tag"
+TERM_WORD = "word"
+
+# outcome of CIFFIndex.update: the number of files in each category
+IndexUpdate = namedtuple("IndexUpdate", ["added", "updated", "removed", "unchanged"])
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    is_valid INTEGER NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    caption TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS terms (
+    kind TEXT NOT NULL,
+    term TEXT NOT NULL,
+    file_id INTEGER NOT NULL REFERENCES files (id),
+    PRIMARY KEY (kind, term, file_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS terms_file_id ON terms (file_id);
+"""
+
+_WORD = re.compile(r"\w+")
+
+
+def caption_words(caption):
+    """
+    Splits a caption into the words it is indexed by
+
+    :param caption: the caption of an image
+    :return: set of the lowercase words
+    """
+    return set(_WORD.findall(caption.lower()))
+
+
+def tag_terms(tags):
+    """
+    The terms the tags of an image are indexed by
+
+    :param tags: the tags as kept by CIFF (with the terminating '\0')
+    :return: set of the tags without the terminating '\0'
+    """
+    return {tag[:-1] if tag.endswith('\0') else tag for tag in tags}
+
+
+class CIFFIndex:
+    """
+    Persistent inverted index from tags and caption words to CIFF files
+
+    Only the headers of the files are read (see CIFF.probe). The tags are
+    indexed as they are, the caption by its lowercase words. Updates are
+    incremental: a file is only probed again if its size or modification
+    time changed since it was indexed. Invalid files are recorded, but
+    their terms are not indexed.
+    """
+
+    def __init__(self, db_path=DEFAULT_INDEX_PATH):
+        """
+        Constructor for CIFF indexes
+
+        :param db_path: path of the SQLite database, created if missing
+        """
+        self._connection = sqlite3.connect(db_path)
+        self._connection.executescript(_SCHEMA)
+
+    def update(self, directory):
+        """
+        Brings the index of a directory tree up to date
+
+        New and changed .ciff files are probed and indexed, the entries of
+        the files deleted from the tree are removed.
+
+        :param directory: root of the directory tree
+        :return: IndexUpdate counting the files
+        """
+        root = os.path.abspath(directory)
+        indexed = dict(self._connection.execute(
+            "SELECT path, size || ':' || mtime_ns FROM files WHERE path >= ? AND path < ?",
+            _prefix_range(root)
+        ).fetchall())
+        added = updated = unchanged = 0
+        for dir_path, _, file_names in os.walk(root):
+            for file_name in file_names:
+                if not file_name.lower().endswith(CIFF_EXTENSION):
+                    continue
+                file_path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue
+                identity = indexed.pop(file_path, None)
+                if identity == f"{stat.st_size}:{stat.st_mtime_ns}":
+                    unchanged += 1
+                    continue
+                self._index_file(file_path, stat)
+                if identity is None:
+                    added += 1
+                else:
+                    updated += 1
+        # whatever was not found during the walk is gone
+        for file_path in indexed:
+            self._remove_file(file_path)
+        self._connection.commit()
+        return IndexUpdate(added, updated, len(indexed), unchanged)
+
+    def search(self, tags=(), words=(), include_invalid=False):
+        """
+        Looks up the files having every given tag and caption word
+
+        :param tags: tags the files must have (without the terminating '\0')
+        :param words: words the captions must contain (case-insensitive)
+        :param include_invalid: also return the invalid files if no tags
+                                or words are given
+        :return: sorted list of the paths of the matching files
+        """
+        conditions = []
+        parameters = []
+        for kind, terms in ((TERM_TAG, tags), (TERM_WORD, words)):
+            for term in terms:
+                if kind == TERM_WORD:
+                    term = term.lower()
+                conditions.append("id IN (SELECT file_id FROM terms WHERE kind = ? AND term = ?)")
+                parameters += [kind, term]
+        if not include_invalid:
+            conditions.append("is_valid = 1")
+        query = "SELECT path FROM files"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        return [path for path, in self._connection.execute(query + " ORDER BY path", parameters)]
+
+    def files_with_tag(self, tag):
+        """
+        Looks up the files having a tag
+
+        :param tag: the tag (without the terminating '\0')
+        :return: sorted list of the paths of the matching files
+        """
+        return self.search(tags=[tag])
+
+    def files_with_word(self, word):
+        """
+        Looks up the files whose caption contains a word
+
+        :param word: the word (case-insensitive)
+        :return: sorted list of the paths of the matching files
+        """
+        return self.search(words=[word])
+
+    def terms(self, kind=TERM_TAG):
+        """
+        Counts the files per term
+
+        :param kind: TERM_TAG or TERM_WORD
+        :return: list of (term, number of files) pairs, the most frequent first
+        """
+        return self._connection.execute(
+            "SELECT term, COUNT(*) FROM terms WHERE kind = ? GROUP BY term ORDER BY COUNT(*) DESC, term",
+            (kind,)
+        ).fetchall()
+
+    def close(self):
+        """
+        Commits the pending changes and closes the database
+        """
+        self._connection.commit()
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def _index_file(self, file_path, stat):
+        header = CIFF.probe(file_path)
+        self._remove_file(file_path)
+        file_id = self._connection.execute(
+            "INSERT INTO files (path, size, mtime_ns, is_valid, width, height, caption) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                file_path, stat.st_size, stat.st_mtime_ns, int(header.is_valid),
+                header.width, header.height, header.caption if header.is_valid else ""
+            )
+        ).lastrowid
+        if not header.is_valid:
+            return
+        self._connection.executemany(
+            "INSERT INTO terms VALUES (?, ?, ?)",
+            [(TERM_TAG, tag, file_id) for tag in tag_terms(header.tags)] +
+            [(TERM_WORD, word, file_id) for word in caption_words(header.caption)]
+        )
+
+    def _remove_file(self, file_path):
+        self._connection.execute(
+            "DELETE FROM terms WHERE file_id IN (SELECT id FROM files WHERE path = ?)", (file_path,)
+        )
+        self._connection.execute("DELETE FROM files WHERE path = ?", (file_path,))
+
+
+def _prefix_range(root):
+    """
+    Bounds of the paths inside a directory, for a range query
+
+    :param root: absolute path of the directory
+    :return: (lower bound, upper bound) of the paths
+    """
+    prefix = root.rstrip(os.sep) + os.sep
+    return prefix, prefix[:-1] + chr(ord(os.sep) + 1)
+
+
+def main():
+    parser = ArgumentParser(description="Index the tags and captions of CIFF files")
+    parser.add_argument("--index", default=DEFAULT_INDEX_PATH, help="SQLite file holding the index")
+    parser.add_argument("--update", metavar="DIRECTORY", action="append", default=[],
+                        help="index the changes of a directory tree first (can be repeated)")
+    parser.add_argument("--tag", action="append", default=[], help="list the files with this tag")
+    parser.add_argument("--word", action="append", default=[],
+                        help="list the files with this word in their caption")
+    parser.add_argument("--tags", action="store_true", help="list the tags by the number of files")
+    args = parser.parse_args()
+
+    with CIFFIndex(args.index) as index:
+        for directory in args.update:
+            update = index.update(directory)
+            print(f"{directory}: {update.added} added, {update.updated} updated, "
+                  f"{update.removed} removed, {update.unchanged} unchanged")
+        if args.tags:
+            for tag, count in index.terms(TERM_TAG):
+                print(f"{count:8d}  {tag}")
+        if args.tag or args.word:
+            for file_path in index.search(args.tag, args.word):
+                print(file_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,23 @@
 import ctypes
+import os
+import sys
+import threading
 from ctypes import c_char_p, Structure, POINTER, c_int64, c_bool, c_uint8
-from ciff import CIFF
+from ciff import CIFF, PixelBuffer, ERROR_NON_ASCII, ERROR_UNKNOWN
+
+# file name of the library built from ciff.cpp, see the README
+if sys.platform == "win32":
+    LIBRARY_NAME = "ciff_parser.dll"
+else:
+    LIBRARY_NAME = "libciff_parser.so"
+
+# environment variable that overrides the path of the library
+LIBRARY_PATH_VARIABLE = "CIFF_NATIVE_LIBRARY"
+
+_library = None
+_library_path = None
+_library_lock = threading.Lock()
+
 
 # Definiáljuk a struct-okat Pythonban is
 class RGBPixel(ctypes.Structure):
@@ -21,76 +38,160 @@ class CIFF_Export(Structure):
         ("is_valid", c_bool)
     ]
 
-def load_native_ciff_image(filepath):
-    try:
-        if isinstance(filepath, str):
-            filepath = filepath.encode('utf-8')
-        lib = ctypes.cdll.LoadLibrary("./ciff_parser.dll")
+def default_library_path():
+    """
+    The path the native library is loaded from
+
+    :return: the value of CIFF_NATIVE_LIBRARY if it is set, otherwise the
+             library next to this module
+    """
+    return os.environ.get(LIBRARY_PATH_VARIABLE) or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), LIBRARY_NAME
+    )
+
+def load_library(library_path=None):
+    """
+    Loads the native parser library and declares its functions
 
+    The library is only loaded on the first call, later calls return the
+    same handle. A library cannot be unloaded, so once one is loaded,
+    asking for another path is an error.
+
+    :param library_path: path of the library, see default_library_path()
+    :return: the ctypes handle of the library
+    :raises OSError: if the library cannot be loaded, or another library
+                     was loaded already
+    """
+    global _library, _library_path
+    with _library_lock:
+        if _library is not None:
+            if library_path is not None and os.path.realpath(library_path) != _library_path:
+                raise OSError(f"The native library was already loaded from {_library_path}")
+            return _library
+        library_path = library_path or default_library_path()
+        lib = ctypes.CDLL(library_path)
         lib.parse.argtypes = [c_char_p]
         lib.parse.restype = POINTER(CIFF_Export)
-        print("Loading CIFF file:", filepath)
-        #filepath = b"./test-vectors/test1.ciff"
-        ciff_ptr = lib.parse(filepath)
-        print("CIFF pointer")
-        new_ciff = CIFF()
-        if not ciff_ptr:
-            print("Failed to parse CIFF file")
-            new_ciff.is_valid = False
-            return new_ciff
+        # libraries built before parse_buffer was added only parse files
+        if hasattr(lib, "parse_buffer"):
+            lib.parse_buffer.argtypes = [ctypes.c_void_p, c_int64]
+            lib.parse_buffer.restype = POINTER(CIFF_Export)
+        if hasattr(lib, "set_max_content_size"):
+            lib.set_max_content_size.argtypes = [c_int64]
+            lib.set_max_content_size.restype = None
+        lib.free_ciff.argtypes = [POINTER(CIFF_Export)]
+        lib.free_ciff.restype = None
+        _library = lib
+        _library_path = os.path.realpath(library_path)
+        return _library
+
+def set_max_content_size(limit):
+    """
+    Sets the largest pixel payload the native parser accepts
+
+    Images declaring more pixel data are rejected before it is read. The
+    limit is global to the process, there is none by default.
+
+    :param limit: the limit in bytes
+    :raises OSError: if the native library cannot be loaded or is too old
+                     to limit the size
+    """
+    lib = load_library()
+    if not hasattr(lib, "set_max_content_size"):
+        raise OSError("The native library does not support limiting the size, rebuild it")
+    lib.set_max_content_size(limit)
+
+def load_native_ciff_image(filepath):
+    """
+    Parses a CIFF file with the native parser
 
-        new_ciff.is_valid = ciff_ptr.contents.is_valid
+    Everything is copied out of the native result, which is released
+    before returning.
+
+    :param filepath: path the to file to be parsed (string or bytes)
+    :return: the parsed CIFF object
+    :raises OSError: if the native library cannot be loaded
+    """
+    lib = load_library()
+    if isinstance(filepath, str):
+        filepath = os.fsencode(filepath)
+    return _convert_result(lib, lib.parse(filepath))
+
+def load_native_ciff_bytes(buffer):
+    """
+    Parses a CIFF image held in memory with the native parser
+
+    The native parser reads the buffer in place, only read-only buffers
+    other than bytes are copied first.
+
+    :param buffer: the whole image (any object supporting the buffer protocol)
+    :return: the parsed CIFF object
+    :raises OSError: if the native library cannot be loaded or is too old
+                     to parse buffers
+    """
+    lib = load_library()
+    if not hasattr(lib, "parse_buffer"):
+        raise OSError("The native library does not support parsing buffers, rebuild it")
+    if not isinstance(buffer, bytes):
+        data = memoryview(buffer).cast("B")
+        if data.readonly:
+            buffer = data.tobytes()
+        else:
+            buffer = (ctypes.c_char * len(data)).from_buffer(data)
+    return _convert_result(lib, lib.parse_buffer(buffer, len(buffer)))
+
+def _convert_result(lib, ciff_ptr):
+    """
+    Copies the result of the native parser into a CIFF object
+
+    :param lib: the ctypes handle of the library
+    :param ciff_ptr: the pointer returned by the parser, released here
+    :return: the parsed CIFF object
+    """
+    new_ciff = CIFF()
+    if not ciff_ptr:
+        # the native parser does not tell why it rejected the image
+        new_ciff.is_valid = False
+        new_ciff.error_code = ERROR_UNKNOWN
+        return new_ciff
+
+    try:
+        contents = ciff_ptr.contents
+        new_ciff.is_valid = contents.is_valid
         if not new_ciff.is_valid:
-            print("Invalid CIFF file")
+            new_ciff.error_code = ERROR_UNKNOWN
             return new_ciff
 
-        new_ciff.magic = ciff_ptr.contents.magic.decode('utf-8')
-        new_ciff.header_size = ciff_ptr.contents.header_size
-        new_ciff.content_size = ciff_ptr.contents.content_size
-        new_ciff.width = ciff_ptr.contents.width
-        new_ciff.height = ciff_ptr.contents.height
-        new_ciff.caption = ciff_ptr.contents.caption.decode('utf-8')
-        new_ciff.tags = []
-        tags_ptr = ciff_ptr.contents.tags
+        new_ciff.magic = contents.magic.decode('ascii')
+        new_ciff.header_size = contents.header_size
+        new_ciff.content_size = contents.content_size
+        new_ciff.width = contents.width
+        new_ciff.height = contents.height
+        new_ciff.caption = contents.caption.decode('ascii')
+        # the null terminators are part of the tags in CIFF.parse_ciff_file too
+        tags = []
+        tags_ptr = contents.tags
         if tags_ptr:
             i = 0
-            while tags_ptr[i]:
-                new_ciff.tags.append(tags_ptr[i].decode('utf-8'))
+            while tags_ptr[i] is not None:
+                tags.append(tags_ptr[i].decode('ascii') + '\0')
                 i += 1
-        else:
-            new_ciff.tags = []
-        new_ciff.pixels = []
-        pixels_ptr = ciff_ptr.contents.pixels
-        if pixels_ptr:
-            for i in range(ciff_ptr.contents.width * ciff_ptr.contents.height):
-                pixel = pixels_ptr[i]
-                new_ciff.pixels.append((pixel.r, pixel.g, pixel.b))
-        else:
-            new_ciff.pixels = []
+        new_ciff.tags = tags
 
-        lib.free_ciff.argtypes = [POINTER(CIFF_Export)]
-        return new_ciff
-    except Exception as e:
-        print("We ran into an exception", e)
-    #print("CIFF pointer:", ciff_ptr)
-    #if ciff_ptr.contents.is_valid:
-    #    print("isValid:", ciff_ptr.contents.is_valid)
-    #    print("Magic:", ciff_ptr.contents.magic.decode('utf-8'))
-    #    print("Width:", ciff_ptr.contents.width)
-    #    print("Height:", ciff_ptr.contents.height)
-    #    print("Header Size:", ciff_ptr.contents.header_size)
-    #    print("Content Size:", ciff_ptr.contents.content_size)
-    #    print("Caption:", ciff_ptr.contents.caption.decode('utf-8'))
-    #    print("Tags:")
-    #    tags_ptr = ciff_ptr.contents.tags
-    #    if tags_ptr:
-    #        i = 0
-    #        while tags_ptr[i]:
-    #            print(f"  Tag {i}: {tags_ptr[i].decode('utf-8')}")
-    #            i += 1
-    #    else:
-    #        print("  No tags found")
-    #else:
-    #    print("Érvénytelen CIFF fájl")
-#
-    #print("Macska")
+        # RGBPixel is 3 packed bytes, so the array is the raw RGB payload
+        content = bytearray(contents.content_size)
+        if content and contents.pixels:
+            ctypes.memmove(
+                (ctypes.c_char * len(content)).from_buffer(content),
+                contents.pixels,
+                len(content)
+            )
+        new_ciff.pixels = PixelBuffer(content, new_ciff.width, new_ciff.height)
+    except UnicodeDecodeError:
+        # the native parser does not check the character set of the header
+        new_ciff.is_valid = False
+        new_ciff.error_code = ERROR_NON_ASCII
+    finally:
+        lib.free_ciff(ciff_ptr)
+
+    return new_ciff
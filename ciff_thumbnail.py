@@ -0,0 +1,201 @@
+import os
+import threading
+from collections import OrderedDict
+
+from ciff import CIFF, CIFFError, PixelBuffer, ERROR_TRUNCATED_PIXELS
+
+# largest (width, height) of a thumbnail by default
+DEFAULT_THUMBNAIL_SIZE = (160, 160)
+
+# total size of the pixels kept by a ThumbnailCache by default
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+
+def thumbnail_step(width, height, max_size):
+    """
+    The sampling step that makes an image fit into a bounding box
+
+    :param width: width of the image in pixels
+    :param height: height of the image in pixels
+    :param max_size: (width, height) of the bounding box
+    :return: k, every k-th row and column is kept
+    """
+    max_width, max_height = max_size
+    if max_width < 1 or max_height < 1:
+        raise ValueError("Thumbnail size must be positive")
+    # ceiling divisions, so that ceil(width / k) <= max_width
+    return max(-(-width // max_width), -(-height // max_height), 1)
+
+
+def covering_size(width, height, target_size):
+    """
+    The bounding box to sample an image into before resizing it to a target
+
+    The sampling step of make_thumbnail is an integer, so an image fitted
+    into the target directly can end up barely larger than half of it.
+    Sampled into this box, the image keeps at least the resolution of the
+    target, and a resampling filter can do the exact fit.
+
+    :param width: width of the image in pixels
+    :param height: height of the image in pixels
+    :param target_size: (width, height) the image will be shown at
+    :return: (width, height) to pass to make_thumbnail as max_size
+    """
+    target_width, target_height = target_size
+    step = max(min(width // target_width, height // target_height), 1)
+    return max(-(-width // step), 1), max(-(-height // step), 1)
+
+
+def make_thumbnail(file_path, max_size=DEFAULT_THUMBNAIL_SIZE, cache=None, progress=None):
+    """
+    Decodes a downscaled preview of a CIFF file
+
+    The image is validated like by CIFF.probe, including the size of the
+    file, then only every k-th row is read and every k-th pixel of those
+    rows is kept, so a preview of a huge image costs a fraction of
+    decoding it. The aspect ratio is kept; images that already fit are
+    decoded at full size.
+
+    :param file_path: path of the CIFF file
+    :param max_size: (width, height) the thumbnail must fit into
+    :param cache: a ThumbnailCache to reuse and store previews in, or None
+    :param progress: function called with the number of decoded rows and
+                     the number of all rows after each row, or None; an
+                     exception raised by it aborts the decoding
+    :return: PixelBuffer holding the thumbnail
+    :raises CIFFError: if the image is not valid
+    :raises ValueError: if max_size is not positive
+    """
+    # taken before decoding, so a file replaced meanwhile does not get the
+    # preview of its previous version cached under its identity
+    key = ThumbnailCache.key_of(file_path, max_size) if cache is not None else None
+    if key is not None:
+        thumbnail = cache.lookup(key)
+        if thumbnail is not None:
+            return thumbnail
+
+    header = CIFF.probe(file_path)
+    if not header.is_valid:
+        raise CIFFError("Invalid image: cannot make a thumbnail", header.error_code)
+    width, height = header.width, header.height
+    step = thumbnail_step(width, height, max_size)
+    rows = range(0, height, step)
+    thumbnail_width = len(range(0, width, step))
+    stride = width * 3
+    thumbnail_stride = thumbnail_width * 3
+
+    data = bytearray(thumbnail_stride * len(rows))
+    if data:
+        with open(file_path, "rb") as ciff_file:
+            for i, y in enumerate(rows):
+                # the rows in between are skipped without reading them
+                ciff_file.seek(header.header_size + y * stride)
+                row = ciff_file.read(stride)
+                if len(row) != stride:
+                    # the file was truncated since it was probed
+                    raise CIFFError("Invalid image: pixel data not found", ERROR_TRUNCATED_PIXELS)
+                offset = i * thumbnail_stride
+                for channel in range(3):
+                    data[offset + channel:offset + thumbnail_stride:3] = row[channel::3 * step]
+                if progress is not None:
+                    progress(i + 1, len(rows))
+    thumbnail = PixelBuffer(data, thumbnail_width, len(rows))
+
+    if key is not None:
+        cache.store(key, thumbnail)
+    return thumbnail
+
+
+class ThumbnailCache:
+    """
+    In-memory cache of thumbnails, bounded by the total size of their pixels
+
+    Like in ValidationCache, an entry belongs to the size, the modification
+    time and the inode of the file, so the thumbnail of a changed file is
+    decoded again. The least recently used thumbnails are evicted once the
+    cache holds more than max_bytes of pixels. The cache can be shared by
+    threads.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        """
+        Constructor for thumbnail caches
+
+        :param max_bytes: the maximal total size of the cached pixels
+        """
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        """
+        Total size of the cached pixels in bytes
+
+        :return: int
+        """
+        return self._size
+
+    @staticmethod
+    def key_of(file_path, max_size):
+        """
+        The key the thumbnail of a file is cached under
+
+        It holds the size, the modification time and the inode of the file,
+        and has to be taken before the file is decoded, like the identity
+        of a file in ValidationCache.
+
+        :param file_path: path of the file
+        :param max_size: (width, height) the thumbnail is made for
+        :return: the key, or None if the file cannot be accessed
+        """
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        return (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns, stat.st_ino, tuple(max_size))
+
+    def lookup(self, key):
+        """
+        Looks up a thumbnail
+
+        :param key: the key of the file, see key_of
+        :return: PixelBuffer, or None if the file is not cached or changed
+        """
+        with self._lock:
+            thumbnail = self._entries.get(key)
+            if thumbnail is not None:
+                self._entries.move_to_end(key)
+            return thumbnail
+
+    def store(self, key, thumbnail):
+        """
+        Stores a thumbnail, evicting the oldest ones if needed
+
+        :param key: the key of the file taken before it was decoded, see key_of
+        :param thumbnail: PixelBuffer holding the thumbnail
+        """
+        size = len(thumbnail.data)
+        if size > self._max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous.data)
+            self._entries[key] = thumbnail
+            self._size += size
+            while self._size > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted.data)
+
+    def clear(self):
+        """
+        Drops every cached thumbnail
+        """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def __len__(self):
+        return len(self._entries)
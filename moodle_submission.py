@@ -1,19 +1,118 @@
-from ciff import CIFF
-from os import listdir
-from os.path import join, extsep
-
-for test_vector in sorted(
-        [f for f in listdir("test-vectors")],
-        key=lambda f: int(
-            f.replace("test", "").rsplit(extsep, 1)[0].rsplit(None, 1)[-1]
-        )
-):
-    try:
-        ciff_file = CIFF.parse_ciff_file(join("test-vectors", test_vector))
-        if ciff_file.is_valid:
-            print(test_vector + "\t is detected as \tVALID")
-        else:
-            print(test_vector + "\t is detected as \tINVALID")
-    except Exception as e:
+from argparse import ArgumentParser
+from collections import Counter
+from os import cpu_count
+from os.path import basename, join
+
+from ciff import ERROR_UNKNOWN, PHASE_CAPTION, PHASE_HEADER, PHASE_PIXELS, PHASE_TAGS, PHASE_TRAILING
+from ciff_batch import (
+    CHANGE_REMOVED, DEFAULT_POLL_INTERVAL, DEFAULT_TIMEOUT, sorted_test_vectors, validate_files, watch_directory
+)
+from ciff_cache import DEFAULT_MAX_ENTRIES, ValidationCache
+
+
+def print_result(result):
+    test_vector = basename(result.path)
+    if result.error is not None:
         print("Error processing " + test_vector)
-        print(e)
+        print(result.error)
+    elif result.is_valid:
+        print(test_vector + "\t is detected as \tVALID")
+    else:
+        print(test_vector + "\t is detected as \tINVALID")
+
+
+def print_profile(profiles):
+    print()
+    print(f"Parser profile of {len(profiles)} parsed files:")
+    print(f"{'phase':>10}  {'total ms':>10}  {'mean ms':>10}")
+    for phase in (PHASE_HEADER, PHASE_CAPTION, PHASE_TAGS, PHASE_PIXELS, PHASE_TRAILING):
+        total = sum(profile.phase_seconds.get(phase, 0.0) for profile in profiles) * 1000
+        mean = total / len(profiles) if profiles else 0.0
+        print(f"{phase:>10}  {total:10.3f}  {mean:10.3f}")
+    print(f"{sum(profile.bytes_read for profile in profiles)} bytes read "
+          f"in {sum(profile.read_calls for profile in profiles)} read() calls")
+    mapped = sum(profile.mode == "mmap" for profile in profiles)
+    if mapped:
+        # over the memory budget, their pixels were not read while parsing
+        print(f"{mapped} files were memory-mapped, their pixel time excludes paging them in")
+    print("Slowest files:")
+    slowest = sorted(profiles, key=lambda profile: sum(profile.phase_seconds.values()), reverse=True)
+    for profile in slowest[:5]:
+        print(f"{sum(profile.phase_seconds.values()) * 1000:10.3f} ms  {basename(profile.path)}")
+
+
+def main():
+    parser = ArgumentParser(description="Validate every CIFF test vector")
+    parser.add_argument("directory", nargs="?", default="test-vectors",
+                        help="directory holding the test vectors")
+    parser.add_argument("--jobs", type=int, default=cpu_count(),
+                        help="number of worker processes (default: CPU count)")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT,
+                        help="seconds a single file may take")
+    parser.add_argument("--cache",
+                        help="SQLite file to cache the verdicts of unchanged files in")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_ENTRIES,
+                        help="the maximal number of cached verdicts")
+    parser.add_argument("--hash", action="store_true",
+                        help="also reuse cached verdicts of files with the same contents")
+    parser.add_argument("--summary", action="store_true",
+                        help="count the rejected files by the reason of the rejection")
+    parser.add_argument("--profile", action="store_true",
+                        help="time the phases of the parsing (cached files are not parsed)")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep validating the added and modified files until interrupted")
+    parser.add_argument("--interval", type=float, default=DEFAULT_POLL_INTERVAL,
+                        help="seconds between two scans of the directory in watch mode")
+    args = parser.parse_args()
+
+    cache = None
+    if args.cache:
+        cache = ValidationCache(args.cache, max_entries=args.cache_size, hash_content=args.hash)
+    if args.watch:
+        changes = None
+        try:
+            changes = watch_directory(args.directory, args.interval, args.jobs, args.timeout, cache)
+            for change in changes:
+                if change.kind == CHANGE_REMOVED:
+                    print(basename(change.result.path) + "\t was removed")
+                else:
+                    print_result(change.result)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if changes is not None:
+                # terminates the workers of the watcher
+                changes.close()
+            if cache is not None:
+                cache.close()
+        return
+
+    results = validate_files(
+        [join(args.directory, test_vector) for test_vector in sorted_test_vectors(args.directory)],
+        jobs=args.jobs,
+        timeout=args.timeout,
+        cache=cache,
+        profile=args.profile
+    )
+    rejections = Counter()
+    profiles = []
+    for result in results:
+        if result.profile is not None:
+            profiles.append(result.profile)
+        if result.is_valid is False:
+            # entries cached by older versions have no error code
+            rejections[result.metadata.get("error_code", ERROR_UNKNOWN)] += 1
+        print_result(result)
+    if cache is not None:
+        cache.close()
+    if args.summary:
+        print()
+        print("Rejected files by reason:")
+        for error_code, count in rejections.most_common():
+            print(f"{count:8d}  {error_code}")
+    if args.profile:
+        print_profile(profiles)
+
+
+if __name__ == "__main__":
+    main()
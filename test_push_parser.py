@@ -0,0 +1,187 @@
+import struct
+from os import listdir
+from os.path import join
+
+import pytest
+
+from ciff import (
+    CIFF, CIFFError, CIFFPushParser,
+    ERROR_BAD_MAGIC, ERROR_CONTENT_SIZE, ERROR_CONTENT_SIZE_MISMATCH, ERROR_DIMENSIONS,
+    ERROR_HEADER_SIZE, ERROR_MISSING_CAPTION, ERROR_NEWLINE_IN_TAGS, ERROR_NON_ASCII,
+    ERROR_TRAILING_DATA, ERROR_TRUNCATED_HEADER, ERROR_TRUNCATED_PIXELS, ERROR_UNTERMINATED_TAG
+)
+
+TEST_VECTORS = "test-vectors"
+
+# sizes the images are fed in: single bytes and odd sizes that split every
+# field of the header at a different position
+CHUNK_SIZES = [1, 2, 7, 13, 37, 4099]
+
+
+def build_image(magic=b"CIFF", header_rest=b"a caption\ntag1\0tag2\0",
+                width=2, height=3, content_size=None, header_size=None, pixels=None, extra=b""):
+    """
+    Assembles a CIFF image field by field, so any field can be forged
+
+    :return: the image (bytes)
+    """
+    if content_size is None:
+        content_size = width * height * 3
+    if header_size is None:
+        header_size = 36 + len(header_rest)
+    if pixels is None:
+        pixels = bytes(i % 256 for i in range(max(content_size, 0)))
+    return struct.pack("<4sqqqq", magic, header_size, content_size, width, height) + header_rest + pixels + extra
+
+
+VALID_IMAGE = build_image()
+
+# images with a single problem, so every parser has to name the same one
+INVALID_IMAGES = {
+    ERROR_TRUNCATED_HEADER: VALID_IMAGE[:20],
+    ERROR_BAD_MAGIC: build_image(magic=b"CIFX"),
+    ERROR_HEADER_SIZE: build_image(header_size=10),
+    ERROR_CONTENT_SIZE: build_image(content_size=-3, pixels=b""),
+    ERROR_DIMENSIONS: build_image(width=-1, content_size=0),
+    ERROR_CONTENT_SIZE_MISMATCH: build_image(content_size=3, pixels=b"abc"),
+    ERROR_NON_ASCII: build_image(header_rest="caption é\ntag\0".encode("latin-1")),
+    ERROR_MISSING_CAPTION: build_image(header_rest=b"no newline\0"),
+    ERROR_NEWLINE_IN_TAGS: build_image(header_rest=b"caption\ntag\none\0"),
+    ERROR_UNTERMINATED_TAG: build_image(header_rest=b"caption\ntag"),
+    ERROR_TRUNCATED_PIXELS: VALID_IMAGE[:-1],
+    ERROR_TRAILING_DATA: build_image(extra=b"\0"),
+}
+
+
+def push_parse(data, chunk_size):
+    """
+    Feeds an image to a CIFFPushParser in chunks of the given size
+
+    :return: the parsed CIFF object
+    """
+    parser = CIFFPushParser()
+    try:
+        for start in range(0, len(data), chunk_size):
+            parser.feed(data[start:start + chunk_size])
+        parser.close()
+    except CIFFError:
+        pass
+    return parser.result
+
+
+def file_parse(tmp_path, data):
+    file_path = tmp_path / "image.ciff"
+    file_path.write_bytes(data)
+    return CIFF.parse_ciff_file(str(file_path))
+
+
+def assert_same_image(pushed, parsed):
+    assert pushed.is_valid == parsed.is_valid
+    assert pushed.error_code == parsed.error_code
+    if parsed.is_valid:
+        assert pushed.metadata == parsed.metadata
+        assert pushed.pixels == parsed.pixels
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_valid_image(tmp_path, chunk_size):
+    pushed = push_parse(VALID_IMAGE, chunk_size)
+    assert pushed.is_valid
+    assert_same_image(pushed, file_parse(tmp_path, VALID_IMAGE))
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+@pytest.mark.parametrize("error_code", sorted(INVALID_IMAGES))
+def test_invalid_image(tmp_path, error_code, chunk_size):
+    data = INVALID_IMAGES[error_code]
+    parsed = file_parse(tmp_path, data)
+    assert parsed.error_code == error_code
+    assert_same_image(push_parse(data, chunk_size), parsed)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 4099])
+def test_empty_image(tmp_path, chunk_size):
+    # no pixels, and a header holding a single tag after an empty caption
+    data = build_image(header_rest=b"\ntag\0", width=0, height=5)
+    pushed = push_parse(data, chunk_size)
+    assert pushed.is_valid
+    assert_same_image(pushed, file_parse(tmp_path, data))
+
+
+@pytest.mark.parametrize("file_name", sorted(listdir(TEST_VECTORS)))
+def test_test_vectors(file_name):
+    file_path = join(TEST_VECTORS, file_name)
+    with open(file_path, "rb") as ciff_file:
+        data = ciff_file.read()
+    parsed = CIFF.parse_ciff_file(file_path)
+    # the header byte by byte, the pixels in odd-sized chunks
+    parser = CIFFPushParser()
+    try:
+        parser.feed(b"")
+        for start in range(512):
+            parser.feed(data[start:start + 1])
+        for start in range(512, len(data), 65537):
+            parser.feed(data[start:start + 65537])
+        parser.close()
+    except CIFFError:
+        pass
+    pushed = parser.result
+    # the push parser may name another problem of an image with several
+    assert pushed.is_valid == parsed.is_valid
+    if parsed.is_valid:
+        assert pushed.metadata == parsed.metadata
+        assert pushed.pixels == parsed.pixels
+
+
+@pytest.mark.parametrize("magic", [b"CIFX", b"ciff", b"\xffIFF", b"CI\x80F"])
+@pytest.mark.parametrize("chunk_size", [1, 4099])
+def test_bad_magic(tmp_path, magic, chunk_size):
+    # a non-ASCII magic is a bad magic, not a non-ASCII header
+    data = build_image(magic=magic)
+    parsed = file_parse(tmp_path, data)
+    assert parsed.error_code == ERROR_BAD_MAGIC
+    assert_same_image(push_parse(data, chunk_size), parsed)
+
+
+def test_rejection_stops_reading():
+    parser = CIFFPushParser()
+    with pytest.raises(CIFFError) as rejection:
+        parser.feed(b"CIX")
+    assert rejection.value.code == ERROR_BAD_MAGIC
+    # everything after the rejection is refused with the same error
+    with pytest.raises(CIFFError):
+        parser.feed(VALID_IMAGE)
+    with pytest.raises(CIFFError):
+        parser.close()
+    assert not parser.result.is_valid
+
+
+@pytest.mark.parametrize("error_code, data", [
+    (ERROR_TRUNCATED_HEADER, build_image(header_size=10 ** 6)),
+    (ERROR_TRUNCATED_PIXELS, build_image(width=1000, height=1000, pixels=b"")),
+    (ERROR_TRAILING_DATA, build_image(extra=b"\0" * 100)),
+])
+def test_expected_size(tmp_path, error_code, data):
+    # the size fields are checked against the announced size right after
+    # the first 36 bytes, like against the size of a file
+    parser = CIFFPushParser(keep_pixels=False, expected_size=len(data))
+    with pytest.raises(CIFFError) as rejection:
+        parser.feed(data[:36])
+    assert rejection.value.code == error_code
+    assert file_parse(tmp_path, data).error_code == error_code
+
+
+def test_expected_size_valid():
+    parser = CIFFPushParser(expected_size=len(VALID_IMAGE))
+    for start in range(len(VALID_IMAGE)):
+        parser.feed(VALID_IMAGE[start:start + 1])
+    assert parser.close().is_valid
+
+
+def test_without_pixels():
+    parser = CIFFPushParser(keep_pixels=False)
+    parser.feed(VALID_IMAGE)
+    parsed = parser.close()
+    assert parsed.is_valid
+    assert (parsed.width, parsed.height) == (2, 3)
+    assert len(parsed.pixels) == 0
@@ -0,0 +1,151 @@
+import itertools
+import os
+
+import pytest
+
+import ciff_batch
+import ciff_cache
+from ciff import ERROR_BAD_MAGIC
+from ciff_batch import check_file, validate_files
+from ciff_cache import ValidationCache, file_identity
+from test_push_parser import INVALID_IMAGES, VALID_IMAGE
+
+# an invalid image of the same size as the valid one, so only the contents
+# and the modification time tell them apart
+SAME_SIZE_INVALID_IMAGE = INVALID_IMAGES[ERROR_BAD_MAGIC]
+
+
+def write_image(file_path, data, mtime_ns):
+    """
+    Writes an image with a given modification time, so the changes do not
+    depend on the resolution of the file system clock
+    """
+    file_path.write_bytes(data)
+    os.utime(file_path, ns=(mtime_ns, mtime_ns))
+
+
+def validate(cache, file_path):
+    results = list(validate_files([str(file_path)], jobs=1, cache=cache))
+    assert len(results) == 1 and results[0].error is None
+    return results[0]
+
+
+@pytest.fixture
+def parsed_files(monkeypatch):
+    """
+    Records the files check_file parses in this process
+    """
+    parsed = []
+    validate_file = ciff_batch.validate_file
+
+    def recording_validate_file(file_path):
+        parsed.append(file_path)
+        return validate_file(file_path)
+
+    monkeypatch.setattr(ciff_batch, "validate_file", recording_validate_file)
+    return parsed
+
+
+@pytest.mark.parametrize("hash_content", [False, True])
+def test_changed_file_is_parsed_again(tmp_path, hash_content):
+    file_path = tmp_path / "image.ciff"
+    write_image(file_path, VALID_IMAGE, 10 ** 18)
+    with ValidationCache(str(tmp_path / "cache.sqlite"), hash_content=hash_content) as cache:
+        assert validate(cache, file_path).is_valid
+        assert cache.lookup(str(file_path)).is_valid
+        write_image(file_path, SAME_SIZE_INVALID_IMAGE, 2 * 10 ** 18)
+        assert cache.lookup(str(file_path)) is None
+        assert not validate(cache, file_path).is_valid
+        assert not cache.lookup(str(file_path)).is_valid
+
+
+def test_file_changed_while_parsed(tmp_path, monkeypatch):
+    # the verdict of the old contents is stored under the identity taken
+    # before the parsing, so it is not reused for the new contents
+    file_path = tmp_path / "image.ciff"
+    write_image(file_path, VALID_IMAGE, 10 ** 18)
+    validate_file = ciff_batch.validate_file
+
+    def replacing_validate_file(file_path):
+        verdict = validate_file(file_path)
+        write_image(tmp_path / "image.ciff", SAME_SIZE_INVALID_IMAGE, 2 * 10 ** 18)
+        return verdict
+
+    monkeypatch.setattr(ciff_batch, "validate_file", replacing_validate_file)
+    with ValidationCache(str(tmp_path / "cache.sqlite")) as cache:
+        identity, (is_valid, metadata) = check_file(str(file_path))
+        assert is_valid
+        cache.store(str(file_path), is_valid, metadata, identity)
+        assert cache.lookup(str(file_path)) is None
+        monkeypatch.setattr(ciff_batch, "validate_file", validate_file)
+        assert not validate(cache, file_path).is_valid
+
+
+def test_touched_file_is_reused_with_hash(tmp_path, parsed_files):
+    file_path = tmp_path / "image.ciff"
+    write_image(file_path, VALID_IMAGE, 10 ** 18)
+    with ValidationCache(str(tmp_path / "cache.sqlite"), hash_content=True) as cache:
+        identity, (is_valid, metadata) = check_file(str(file_path), True)
+        cache.store(str(file_path), is_valid, metadata, identity)
+        assert parsed_files == [str(file_path)]
+
+        # same contents, new modification time: only the hash matches
+        os.utime(file_path, ns=(2 * 10 ** 18, 2 * 10 ** 18))
+        assert cache.lookup(str(file_path)) is None
+        identity, parsed = check_file(str(file_path), True, cache.stored_hash(str(file_path)))
+        assert parsed is None
+        assert parsed_files == [str(file_path)]
+        assert cache.lookup(str(file_path), identity).is_valid
+        # the entry now carries the new identity
+        assert cache.lookup(str(file_path)).is_valid
+
+        # other contents of the same size are parsed
+        write_image(file_path, SAME_SIZE_INVALID_IMAGE, 3 * 10 ** 18)
+        identity, parsed = check_file(str(file_path), True, cache.stored_hash(str(file_path)))
+        assert parsed is not None and not parsed[0]
+        assert parsed_files == [str(file_path)] * 2
+
+
+def test_touched_file_is_not_reused_without_hash(tmp_path):
+    file_path = tmp_path / "image.ciff"
+    write_image(file_path, VALID_IMAGE, 10 ** 18)
+    with ValidationCache(str(tmp_path / "cache.sqlite")) as cache:
+        assert validate(cache, file_path).is_valid
+        os.utime(file_path, ns=(2 * 10 ** 18, 2 * 10 ** 18))
+        assert cache.stored_hash(str(file_path)) is None
+        assert cache.lookup(str(file_path), file_identity(str(file_path), True)) is None
+
+
+def test_max_entries(tmp_path, monkeypatch):
+    # a clock that always moves on, so the ages of the entries differ
+    clock = itertools.count(1)
+    monkeypatch.setattr(ciff_cache.time, "time", lambda: next(clock))
+    file_paths = []
+    for index in range(4):
+        file_path = tmp_path / f"test{index}.ciff"
+        write_image(file_path, VALID_IMAGE, 10 ** 18)
+        file_paths.append(str(file_path))
+
+    with ValidationCache(str(tmp_path / "cache.sqlite"), max_entries=2) as cache:
+        for file_path in file_paths[:3]:
+            cache.store(file_path, True, {}, file_identity(file_path))
+        # using the oldest entry makes the second one the least recently used
+        assert cache.lookup(file_paths[0]) is not None
+        assert len(cache) == 3
+        cache.commit()
+        assert len(cache) == 2
+        assert cache.lookup(file_paths[1]) is None
+        assert cache.lookup(file_paths[0]) is not None
+        assert cache.lookup(file_paths[2]) is not None
+
+        # the lookups above left the first entry the least recently used
+        cache.store(file_paths[3], True, {}, file_identity(file_paths[3]))
+        cache.commit()
+        assert len(cache) == 2
+        assert cache.lookup(file_paths[0]) is None
+
+    # the evictions are written to the disk
+    with ValidationCache(str(tmp_path / "cache.sqlite"), max_entries=2) as cache:
+        assert len(cache) == 2
+        assert cache.lookup(file_paths[2]) is not None
+        assert cache.lookup(file_paths[3]) is not None
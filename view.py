@@ -1,10 +1,157 @@
-from tkinter import Tk, Canvas, NW, Toplevel, Text, Scrollbar, VERTICAL, filedialog, messagebox, END
-from tkinter.ttk import Frame, Label, Button
+import threading
+from collections import deque
+from tkinter import Tk, Canvas, NW, Toplevel, Text, Scrollbar, VERTICAL, filedialog, messagebox, END, DISABLED, NORMAL
+from tkinter.ttk import Frame, Label, Button, Progressbar
 from ciff import CIFF
-from os import listdir
-from os.path import join, extsep
+from ciff_batch import CHANGE_MODIFIED, CHANGE_REMOVED, DEFAULT_POLL_INTERVAL, DirectoryWatcher
+from ciff_cache import ValidationCache
+from ciff_thumbnail import ThumbnailCache, covering_size, make_thumbnail
+from os.path import basename
 from PIL import Image, ImageTk
-from ciff_native import load_native_ciff_image
+
+# size of the canvas, larger images are shown downscaled to fit
+CANVAS_SIZE = (800, 600)
+
+# milliseconds between two checks of the work of a worker thread
+LOAD_POLL_INTERVAL = 50
+
+# directory watched by the test results window
+TEST_VECTORS = "test-vectors"
+
+
+class LoadCancelled(Exception):
+    """
+    Raised in the worker thread of a cancelled ImageLoad
+    """
+
+
+class ImageLoad:
+    """
+    Loads an image for display on a worker thread
+
+    The worker only sets the attributes of the load, the Tk widgets are
+    left to the main thread, which polls done and progress with after().
+    """
+
+    def __init__(self, file_path, thumbnails):
+        """
+        Constructor for image loads, starts the worker thread
+
+        :param file_path: path of the CIFF file
+        :param thumbnails: the ThumbnailCache of the window
+        """
+        self.file_path = file_path
+        self.progress = 0.0
+        self.ciff_image = None
+        self.pil_image = None
+        self.error = None
+        self.done = threading.Event()
+        self.cancelled = threading.Event()
+        self._thumbnails = thumbnails
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def cancel(self):
+        """
+        Stops the worker at the next row, its result is dropped
+        """
+        self.cancelled.set()
+
+    def _run(self):
+        try:
+            # the header is enough for the verdict and the info panel, the
+            # canvas only needs as many pixels as it can show
+            ciff_image = CIFF.probe(self.file_path)
+            if not ciff_image.is_valid:
+                raise ValueError("Invalid CIFF image!")
+            width, height = ciff_image.width, ciff_image.height
+            pixels = make_thumbnail(
+                self.file_path, covering_size(width, height, CANVAS_SIZE),
+                cache=self._thumbnails, progress=self._report
+            )
+
+            size = (pixels.width, pixels.height)
+            if len(pixels):
+                # wrap the raw RGB payload of the parser instead of copying it pixel by pixel
+                pil_image = Image.frombuffer("RGB", size, pixels.data, "raw", "RGB", 0, 1)
+                # the sampled image is at least as large as the canvas,
+                # a proper filter shrinks it to fill the canvas exactly
+                scale = min(CANVAS_SIZE[0] / width, CANVAS_SIZE[1] / height, 1)
+                fitted = (max(round(width * scale), 1), max(round(height * scale), 1))
+                if fitted != size:
+                    pil_image = pil_image.resize(fitted, Image.LANCZOS)
+                self.pil_image = pil_image
+            else:
+                self.pil_image = Image.new("RGB", size)
+            self.ciff_image = ciff_image
+        except LoadCancelled:
+            pass
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+    def _report(self, rows_done, rows):
+        if self.cancelled.is_set():
+            raise LoadCancelled()
+        self.progress = rows_done / rows
+
+
+class TestWatch:
+    """
+    Validates a directory and then its changes on a worker thread
+
+    Like in ImageLoad, the worker only collects the changes found by a
+    DirectoryWatcher, the main thread takes them with take_changes()
+    polled by after(), so parsing the changed files does not freeze the
+    window.
+    """
+
+    def __init__(self, directory, interval=DEFAULT_POLL_INTERVAL):
+        """
+        Constructor for test watches, starts the worker thread
+
+        :param directory: directory of the test vectors
+        :param interval: seconds to wait between two polls
+        """
+        self.directory = directory
+        self.interval = interval
+        self.error = None
+        self.done = threading.Event()
+        self.stopped = threading.Event()
+        self._changes = deque()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        """
+        Stops the worker after the file being validated
+        """
+        self.stopped.set()
+
+    def take_changes(self):
+        """
+        Takes the changes found since the previous call
+
+        :return: list of ciff_batch.VerdictChange tuples
+        """
+        changes = []
+        while self._changes:
+            changes.append(self._changes.popleft())
+        return changes
+
+    def _run(self):
+        try:
+            # an SQLite connection can only be used by the thread opening it
+            with ValidationCache() as cache, DirectoryWatcher(self.directory, cache=cache) as watcher:
+                while not self.stopped.is_set():
+                    for change in watcher.poll():
+                        self._changes.append(change)
+                        if self.stopped.is_set():
+                            break
+                    self.stopped.wait(self.interval)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
 
 
 class Window(Frame):
@@ -13,6 +160,10 @@ class Window(Frame):
         self.master = master
         self._setup_window()
         self.current_image = None
+        # previews of the recently opened images
+        self.thumbnails = ThumbnailCache()
+        # the image being loaded, if any
+        self.loading = None
         self.show_landing_page()
 
     def _setup_window(self):
@@ -24,8 +175,14 @@ class Window(Frame):
         Button(button_frame, text="Run Tests", command=self.run_tests).grid(row=0, column=1, padx=5)
         Button(button_frame, text="About", command=self.show_help).grid(row=0, column=2, padx=5)
 
+        # Progress of loading an image
+        self.progress_bar = Progressbar(button_frame, length=200, maximum=100)
+        self.progress_bar.grid(row=0, column=3, padx=5)
+        self.cancel_button = Button(button_frame, text="Cancel", command=self.cancel_load, state=DISABLED)
+        self.cancel_button.grid(row=0, column=4, padx=5)
+
         # Canvas for images or landing page
-        self.canvas = Canvas(self.master, width=800, height=600, bg="lightgray")
+        self.canvas = Canvas(self.master, width=CANVAS_SIZE[0], height=CANVAS_SIZE[1], bg="lightgray")
         self.canvas.grid(row=1, column=0, padx=10, pady=10)
 
         # Frame for metadata display
@@ -60,23 +217,41 @@ class Window(Frame):
         if not file_path:
             return
 
-        try:
-            ciff_image = load_native_ciff_image(file_path)
-            #ciff_image = CIFF.parse_ciff_file(file_path)
-            if not ciff_image.is_valid:
-                raise ValueError("Invalid CIFF image!")
+        # the image opened before is no longer needed
+        self.cancel_load()
+        self.loading = ImageLoad(file_path, self.thumbnails)
+        self.progress_bar["value"] = 0
+        self.cancel_button.config(state=NORMAL)
+        self.after(LOAD_POLL_INTERVAL, self._poll_load, self.loading)
 
-            self.display_image(ciff_image)
-            self.display_info(ciff_image)
+    def cancel_load(self):
+        if self.loading is not None:
+            self.loading.cancel()
+            self.loading = None
+        self.progress_bar["value"] = 0
+        self.cancel_button.config(state=DISABLED)
 
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to load image:\n{e}")
+    def _poll_load(self, load):
+        if load is not self.loading:
+            # cancelled or replaced by a newer load
+            return
+        if not load.done.is_set():
+            self.progress_bar["value"] = load.progress * 100
+            self.after(LOAD_POLL_INTERVAL, self._poll_load, load)
+            return
+
+        self.loading = None
+        self.progress_bar["value"] = 0
+        self.cancel_button.config(state=DISABLED)
+        if load.error is not None:
+            messagebox.showerror("Error", f"Failed to load image:\n{load.error}")
+            return
+        self.display_image(load.pil_image)
+        self.display_info(load.ciff_image)
 
-    def display_image(self, ciff_image):
+    def display_image(self, pil_image):
         self.canvas.delete("all")
 
-        pil_image = Image.new("RGB", (ciff_image.width, ciff_image.height))
-        pil_image.putdata(ciff_image.pixels)
         photo_image = ImageTk.PhotoImage(pil_image, master=self.canvas)
 
         self.canvas.create_image(0, 0, image=photo_image, anchor=NW)
@@ -114,22 +289,39 @@ class Window(Frame):
         scrollbar.pack(side="right", fill="y")
         result_text.pack(side="left", fill="both", expand=True)
 
-        test_vectors_path = "test-vectors"
-        try:
-            for test_vector in sorted(
-                [f for f in listdir(test_vectors_path)],
-                key=lambda f: int(f.replace("test", "").rsplit(extsep, 1)[0].rsplit(None, 1)[-1])
-            ):
-                try:
-                    ciff_file = CIFF.parse_ciff_file(join(test_vectors_path, test_vector))
-                    if ciff_file.is_valid:
-                        result_text.insert(END, f"{test_vector} is detected as VALID\n")
-                    else:
-                        result_text.insert(END, f"{test_vector} is detected as INVALID\n")
-                except Exception as e:
-                    result_text.insert(END, f"Error processing {test_vector}: {e}\n")
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to run tests:\n{e}")
+        # the directory is watched while the window is open, after the
+        # first round only the added, modified and removed files are shown
+        watch = TestWatch(TEST_VECTORS)
+        pending_poll = None
+
+        def show_changes():
+            nonlocal pending_poll
+            for change in watch.take_changes():
+                result = change.result
+                test_vector = basename(result.path)
+                now = " now" if change.kind == CHANGE_MODIFIED else ""
+                if change.kind == CHANGE_REMOVED:
+                    result_text.insert(END, f"{test_vector} was removed\n")
+                elif result.error is not None:
+                    result_text.insert(END, f"Error processing {test_vector}: {result.error}\n")
+                elif result.is_valid:
+                    result_text.insert(END, f"{test_vector} is{now} detected as VALID\n")
+                else:
+                    result_text.insert(END, f"{test_vector} is{now} detected as INVALID\n")
+            if watch.error is not None:
+                close()
+                messagebox.showerror("Error", f"Failed to run tests:\n{watch.error}")
+                return
+            pending_poll = test_window.after(LOAD_POLL_INTERVAL, show_changes)
+
+        def close():
+            if pending_poll is not None:
+                test_window.after_cancel(pending_poll)
+            watch.stop()
+            test_window.destroy()
+
+        test_window.protocol("WM_DELETE_WINDOW", close)
+        show_changes()
 
 
 if __name__ == "__main__":